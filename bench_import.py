@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# Startup cost of watchlist_update.py from python -X importtime. Heavy dependencies are only imported when a
+# stage needs them, so importing the module or running --help must not load any of them, and a narrow run only
+# loads what its fields need. The narrow run updates whale_holders for one ticker, replayed from an empty
+# recording in a scratch directory. Exits 1 if a module a case doesn't need is loaded or the import and help
+# cases take more than --budget, so it can be run as a regression check.
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(SCRIPT_DIR, 'watchlist_update.py')
+HEAVY = ['gspread', 'oauth2client', 'numpy', 'pandas', 'requests', 'lxml', 'yfinance', 'finvizfinance', 'bs4']
+# command and the heavy modules it's allowed to load
+CASES = {'import': (['-c', 'import watchlist_update'], []),
+         'help': ([SCRIPT, '--help'], []),
+         # whalewisdom pages are fetched with requests and parsed with lxml, numpy works out the stage timings
+         'narrow': ([SCRIPT, '--fields', 'whale_holders', '--replay', 'replay', '--replay-latency', '0',
+                     '--no-cache', '--no-history'], ['requests', 'lxml', 'numpy'])
+         }
+
+
+def make_workdir():
+    # a sheet with one ticker, a config and the tickers file from before the journal
+    workdir = tempfile.mkdtemp(prefix='bench_import_')
+    os.makedirs(os.path.join(workdir, 'replay'))
+    with open(os.path.join(workdir, 'replay', 'sheet_values.json'), 'w') as file:
+        json.dump([['hdr'], ['TICKER'], ['AAA']], file)
+    with open(os.path.join(workdir, 'config.yaml'), 'w') as file:
+        file.write('{}\n')
+    with open(os.path.join(workdir, 'prior_tickers.csv'), 'w') as file:
+        file.write('0,AAA\n')
+    return workdir
+
+
+def import_times(command, workdir):
+    # (module, self us, cumulative us) for each import, top level imports have no indent
+    env = dict(os.environ, PYTHONPATH=SCRIPT_DIR)
+    output = subprocess.run([sys.executable, '-X', 'importtime'] + command, cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if output.returncode != 0:
+        print(output.stderr.decode('utf-8', 'replace')[-2000:])
+        raise RuntimeError('{} failed'.format(' '.join(command)))
+    times = []
+    for line in output.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        # one space after the bar, then two more for each level of nesting
+        times.append((name[1:].rstrip(), int(self_us), int(cumulative)))
+    return times
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Import time check")
+    parser.add_argument('--budget', help="Most milliseconds of imports allowed for importing and --help",
+                        type=float, default=300.)
+    parser.add_argument('--repeat', help="Runs of each case, the fastest is kept", type=int, default=5)
+    parser.add_argument('--top', help="Slowest top level imports to show", type=int, default=8)
+    args = parser.parse_args()
+
+    failed = False
+    for case, (command, allowed) in CASES.items():
+        workdir = make_workdir()
+        try:
+            runs = [import_times(command, workdir) for n in range(max(1, args.repeat))]
+        finally:
+            shutil.rmtree(workdir)
+        times = min(runs, key=lambda t: sum(self_us for name, self_us, cumulative in t))
+        total = sum(self_us for name, self_us, cumulative in times) / 1e3
+        loaded = sorted(set(name.strip().split('.')[0] for name, self_us, cumulative in times) & set(HEAVY))
+        unneeded = [name for name in loaded if name not in allowed]
+
+        print('{:<8} {:8.1f} ms over {} modules'.format(case, total, len(times)))
+        top = sorted([t for t in times if not t[0].startswith(' ')], key=lambda t: -t[2])[:args.top]
+        for name, self_us, cumulative in top:
+            print('    {:<30} {:8.1f} ms'.format(name, cumulative / 1e3))
+        if len(loaded) > 0:
+            print('    heavy modules imported:', ', '.join(loaded))
+        if len(unneeded) > 0:
+            print('    not needed:', ', '.join(unneeded))
+            failed = True
+        if (len(allowed) == 0) and (total > args.budget):
+            print('    over budget of {} ms'.format(args.budget))
+            failed = True
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__': main()
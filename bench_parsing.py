@@ -0,0 +1,279 @@
+import argparse
+import io
+import os
+import random
+import sys
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from bs4 import BeautifulSoup
+from lxml import html
+
+import watchlist_update as wu
+
+# Compare the old BeautifulSoup / pd.read_html parsing with the lxml parsing in watchlist_update
+# on saved pages. Pages are kept in the fixtures directory as <TICKER>_stats.html,
+# <TICKER>_analysis.html and <TICKER>_insider.html, use --download to save real pages first or
+# --generate to make synthetic ones laid out like them. Exits 1 if the two parsers differ on a page.
+
+PAGES = {'stats': (wu.YAHOO_STATS_URL, wu.YAHOO_HEADERS),
+         'analysis': (wu.YAHOO_ANALYSIS_URL, wu.YAHOO_HEADERS),
+         'insider': (wu.OPENINSIDER_URL, None)
+         }
+
+
+def old_yahoo_dict(table):
+
+    rows = table.find_all('tr')
+    data = []
+    for row in rows[1:]:
+        cols = row.find_all('td')
+        cols = [ele.text.strip() for ele in cols]
+        data.append([ele for ele in cols if ele])
+
+    dict = {}
+    for d in data:
+        dict[d[0]] = d[1:]
+
+    return dict
+
+
+def old_stats(content, ticker):
+
+    soup = BeautifulSoup(content, features="lxml")
+    table = soup.find('section', {"data-test": "qsp-statistics"})
+    stats_df = pd.DataFrame.from_dict(old_yahoo_dict(table), orient='index')
+    return {label: stats_df[0][label] for label in stats_df.index}
+
+
+def new_stats(content, ticker):
+
+    tree = html.fromstring(content)
+    table = tree.find('.//section[@data-test="qsp-statistics"]')
+    stats_dict = wu.yahoo_dict(table)
+    return {label: values[0] if len(values) > 0 else np.nan for label, values in stats_dict.items()}
+
+
+def old_analysis(content, ticker):
+
+    soup = BeautifulSoup(content, features="lxml")
+    tables = []
+    for reactid, columns in [('86', ['Current qtr', 'Next qtr', 'Current year', 'Next year']),
+                             ('178', ['q-4', 'q-3', 'q-2', 'q-1']),
+                             ('387', [ticker, 'Industry', 'Sector', 'S&P 500'])]:
+        table = soup.find('table', {"data-reactid": reactid})
+        df = pd.DataFrame.from_dict(old_yahoo_dict(table), orient='index', columns=columns)
+        tables.append({col: dict(df[col]) for col in columns})
+    return tables
+
+
+def new_analysis(content, ticker):
+
+    tree = html.fromstring(content)
+    tables = []
+    for reactid, columns in [('86', ['Current qtr', 'Next qtr', 'Current year', 'Next year']),
+                             ('178', ['q-4', 'q-3', 'q-2', 'q-1']),
+                             ('387', [ticker, 'Industry', 'Sector', 'S&P 500'])]:
+        table = tree.find('.//table[@data-reactid="{}"]'.format(reactid))
+        tables.append(wu.yahoo_columns(wu.yahoo_dict(table), columns))
+    return tables
+
+
+def old_insider(content, ticker):
+
+    table = pd.read_html(io.StringIO(content.decode('utf-8', 'replace')))[11]
+    table.columns = [str(col).replace('\xa0', ' ') for col in table.columns]
+    return list(zip(table['Filing Date'].astype(str), table['Value'].astype(str)))
+
+
+def new_insider(content, ticker):
+
+    header, rows = wu.find_table(html.fromstring(content), ['Filing Date', 'Value'])
+    value_col, filed_col = header.index('Value'), header.index('Filing Date')
+    return [(row[filed_col], row[value_col]) for row in rows]
+
+
+PARSERS = {'stats': (old_stats, new_stats),
+           'analysis': (old_analysis, new_analysis),
+           'insider': (old_insider, new_insider)
+           }
+
+
+# rows on the synthetic pages besides the ones the scrapers read
+STATS_FILLER = ['Market cap (intra-day)', 'Trailing P/E', 'Forward P/E', 'PEG ratio (5-yr expected)', 'Beta (5Y monthly)',
+                '52-week change', '50-day moving average', '200-day moving average', 'Shares outstanding',
+                'Short ratio', 'Forward annual dividend yield', 'Payout ratio', 'Last split date']
+ANALYSIS_TABLES = [('86', 'Revenue estimate', ['Current qtr', 'Next qtr', 'Current year', 'Next year'],
+                    ['No. of analysts', 'Avg. Estimate', 'Low estimate', 'High estimate', 'Year ago sales',
+                     'Sales growth (year/est)']),
+                   ('178', 'Earnings history', ['q-4', 'q-3', 'q-2', 'q-1'],
+                    ['EPS est.', 'EPS actual', 'Difference', 'Surprise %']),
+                   ('387', 'Growth estimates', None,
+                    ['Current qtr', 'Next qtr', 'Current year', 'Next year', 'Next 5 years (per annum)',
+                     'Past 5 years (per annum)'])]
+INSIDER_HEADER = ['X', 'Filing Date', 'Trade Date', 'Ticker', 'Insider Name', 'Title', 'Trade Type', 'Price', 'Qty',
+                  'Owned', 'ΔOwn', 'Value']
+
+
+def number(rng, suffix=''):
+    return '{:.2f}{}'.format(rng.uniform(-100, 100), suffix)
+
+
+def table(header, rows, attrs=''):
+    # header None for a table of data rows only
+    cells = lambda row, tag: ''.join('<{0}><span>{1}</span></{0}>'.format(tag, cell) for cell in row)
+    body = ''.join('<tr>{}</tr>'.format(cells(row, 'td')) for row in rows)
+    head = '' if header is None else '<thead><tr>{}</tr></thead>'.format(cells(header, 'th'))
+    return '<table{}>{}<tbody>{}</tbody></table>'.format(attrs, head, body)
+
+
+def page(title, body, rng):
+    # navigation and scripts around the content, like the real pages have
+    nav = ''.join('<li><a href="/{0}">{0}</a></li>'.format('link{}'.format(n)) for n in range(rng.randint(20, 40)))
+    script = '<script>var data = {};</script>'.format(rng.random())
+    return '<html><head><title>{}</title>{}</head><body><ul>{}</ul>{}</body></html>'.format(title, script, nav, body)
+
+
+def stats_page(ticker, rng):
+
+    labels = list(wu.YAHOO_STATS_FIELDS.values()) + STATS_FILLER
+    rng.shuffle(labels)
+    values = lambda label: '{}{}'.format(number(rng), rng.choice(['%', 'M', 'B', 'k', '']))
+    # a few tables in the statistics section, the first row of the section is a heading the parsers skip
+    tables = [table(None, [['Valuation measures', 'Current']])]
+    tables += [table(None, [[label, values(label)] for label in labels[n:n + 6]]) for n in range(0, len(labels), 6)]
+    return page(ticker + ' statistics', '<section data-test="qsp-statistics">{}</section>'.format(''.join(tables)),
+                rng)
+
+
+def analysis_page(ticker, rng):
+
+    tables = []
+    for reactid, title, columns, labels in ANALYSIS_TABLES:
+        columns = columns or [ticker, 'Industry', 'Sector', 'S&P 500']
+        rows = [[label] + [number(rng, rng.choice(['%', 'B', 'M'])) for col in columns] for label in labels]
+        tables.append(table([title] + columns, rows, ' data-reactid="{}"'.format(reactid)))
+    return page(ticker + ' analysis', ''.join(tables), rng)
+
+
+def insider_page(ticker, rng):
+
+    # the filings are the twelfth table on the page, pd.read_html found them by position
+    layout = [table(['Menu', 'Link'], [['Item {}'.format(n), 'Go']]) for n in range(11)]
+    rows = []
+    for n in range(rng.randint(5, 40)):
+        rows.append(['D', '2024-{:02d}-{:02d} 16:{:02d}:00'.format(rng.randint(1, 12), rng.randint(1, 28), n % 60),
+                     '2024-01-02', ticker, 'Insider {}'.format(n), 'Dir', rng.choice(['P - Purchase', 'S - Sale']),
+                     '${:.2f}'.format(rng.uniform(1, 500)), '+{:,}'.format(rng.randint(1, 10 ** 5)),
+                     '{:,}'.format(rng.randint(1, 10 ** 6)), '+{}%'.format(rng.randint(1, 99)),
+                     '+${:,}'.format(rng.randint(1, 10 ** 7))])
+    return page(ticker + ' insider trading', ''.join(layout) + table(INSIDER_HEADER, rows), rng)
+
+
+GENERATORS = {'stats': stats_page,
+              'analysis': analysis_page,
+              'insider': insider_page
+              }
+
+
+def generate(fixtures, count, seed=0):
+
+    os.makedirs(fixtures, exist_ok=True)
+    rng = random.Random(seed)
+    for n in range(count):
+        ticker = 'SYN{}'.format(n)
+        for kind, make in GENERATORS.items():
+            with open(os.path.join(fixtures, '{}_{}.html'.format(ticker, kind)), 'w', encoding='utf-8') as file:
+                file.write(make(ticker, rng))
+    print('Generated pages for', count, 'tickers in', fixtures)
+
+
+def download(fixtures, tickers):
+
+    os.makedirs(fixtures, exist_ok=True)
+    for ticker in tickers:
+        for kind, (url, headers) in PAGES.items():
+            response = wu.http_get(url.format(ticker), headers=headers)
+            with open(os.path.join(fixtures, '{}_{}.html'.format(ticker, kind)), 'wb') as file:
+                file.write(response.content)
+            print('Saved', kind, 'page for', ticker)
+
+
+def time_parser(parser, content, ticker, repeat):
+
+    start = perf_counter()
+    for n in range(repeat):
+        result = parser(content, ticker)
+    return (perf_counter() - start) / repeat, result
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="HTML parsing benchmark")
+    parser.add_argument('--fixtures', help="Directory of saved pages", type=str, default='fixtures')
+    parser.add_argument('--download', help="Save pages for these tickers first", nargs='+')
+    parser.add_argument('--generate', help="Write synthetic pages for this many tickers first", type=int)
+    parser.add_argument('--repeat', help="Times to parse each page", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.download:
+        wu.http_cache = None
+        download(args.fixtures, args.download)
+    if args.generate:
+        generate(args.fixtures, args.generate)
+
+    if not os.path.isdir(args.fixtures):
+        print('No fixtures directory:', args.fixtures)
+        sys.exit(1)
+
+    totals = {kind: [0., 0., 0] for kind in PARSERS}
+    tickers = set()
+    failed = False
+    for name in sorted(os.listdir(args.fixtures)):
+        if not name.endswith('.html') or '_' not in name:
+            continue
+        ticker, kind = name[:-5].rsplit('_', 1)
+        if kind not in PARSERS:
+            continue
+        with open(os.path.join(args.fixtures, name), 'rb') as file:
+            content = file.read()
+
+        old, new = PARSERS[kind]
+        try:
+            old_time, old_result = time_parser(old, content, ticker, args.repeat)
+            new_time, new_result = time_parser(new, content, ticker, args.repeat)
+        except Exception as e:
+            print('Failed to parse', name, e)
+            failed = True
+            continue
+        if old_result != new_result:
+            print('Different results for', name)
+            failed = True
+
+        totals[kind][0] += old_time
+        totals[kind][1] += new_time
+        totals[kind][2] += 1
+        tickers.add(ticker)
+        print('{:<30} old {:8.2f} ms  new {:8.2f} ms  {:5.1f}x'.format(name, old_time * 1e3, new_time * 1e3,
+                                                                       old_time / new_time))
+
+    if len(tickers) == 0:
+        print('No pages parsed')
+        sys.exit(1)
+
+    old_total = sum(t[0] for t in totals.values())
+    new_total = sum(t[1] for t in totals.values())
+    print()
+    for kind, (old_time, new_time, count) in totals.items():
+        if count > 0:
+            print('{:<10} mean old {:8.2f} ms  new {:8.2f} ms  over {} pages'.format(kind, old_time / count * 1e3,
+                                                                                  new_time / count * 1e3, count))
+    print('CPU per ticker: old {:.2f} ms  new {:.2f} ms  saved {:.2f} ms'.format(
+        old_total / len(tickers) * 1e3, new_total / len(tickers) * 1e3, (old_total - new_total) / len(tickers) * 1e3))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__': main()
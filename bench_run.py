@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import yaml
+
+# End to end throughput of watchlist_update.py without the network. Record a run first with
+#   python watchlist_update.py --all --record fixtures/replay
+# then every mode is run against the recording with each call taking --latency seconds, in a
+# scratch directory so the real state, history, cache and prior_tickers.csv aren't touched.
+# With --spawn each mode is run again as a coordinator with worker processes, and both runs have to write
+# the same values to a csv sink.
+
+MODES = ['all', 'basic', 'eps', 'rev', 'fundamental', 'insider', 'whale']
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'watchlist_update.py')
+# files the script reads from its working directory
+INPUT_FILES = ['ticker_cik.csv', 'prior_tickers.csv']
+
+
+def run_mode(mode, args, config, spawn=0):
+
+    workdir = tempfile.mkdtemp(prefix='bench_')
+    try:
+        for name in INPUT_FILES:
+            if os.path.exists(name):
+                shutil.copy(name, workdir)
+        with open(os.path.join(workdir, 'config.yaml'), 'w') as file:
+            yaml.safe_dump(config, file)
+
+        command = [sys.executable, SCRIPT, '--' + mode,
+                   '--replay', os.path.abspath(args.replay),
+                   '--replay-latency', str(args.latency),
+                   '--workers', str(args.workers),
+                   '--threads', str(args.threads),
+                   '--batchsize', str(args.batchsize),
+                   '--no-cache', '--no-history',
+                   '--summary', 'summary.json'] + args.extra
+        if args.spawn > 0:
+            command += ['--sink', 'csv', '--sink-path', 'values.csv', '--force']
+        if spawn > 0:
+            command += ['--role', 'coordinator', '--spawn', str(spawn), '--queue', 'queue.sqlite']
+        output = subprocess.run(command, cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if output.returncode != 0:
+            print(output.stdout.decode('utf-8', 'replace'))
+            print('Run failed for', mode)
+            return None
+        with open(os.path.join(workdir, 'summary.json'), 'r') as file:
+            summary = json.load(file)
+        if args.spawn > 0:
+            with open(os.path.join(workdir, 'values.csv'), 'r') as file:
+                summary['values'] = file.read()
+        return summary
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Offline end to end benchmark")
+    parser.add_argument('--replay', help="Directory recorded with --record", type=str, default='fixtures/replay')
+    parser.add_argument('--modes', help="Modes to run", nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--latency', help="Seconds each replayed call takes", type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--batchsize', type=int, default=1)
+    parser.add_argument('--config', help="Config file to take limits from", type=str, default='config.yaml')
+    parser.add_argument('--no-limits', help="Turn off the rate limits", action='store_true')
+    parser.add_argument('--spawn', help="Also run each mode as a coordinator with this many worker processes "
+                                        "and check it writes the same values", type=int, default=0)
+    parser.add_argument('extra', help="More arguments for watchlist_update.py, after --", nargs='*')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.replay, 'sheet_values.json')):
+        print('No recording in', args.replay)
+        sys.exit(1)
+
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as file:
+            config = yaml.safe_load(file) or {}
+    if args.no_limits:
+        config['rate_limits'] = {host: {'rate': 1e6, 'burst': 1e6} for host in
+                                 ['sheets', 'yahoo', 'finviz', 'whalewisdom', 'openinsider', 'stocksearning']}
+
+    print('{:<12} {:>7} {:>9} {:>10} {:>10} {:>10}  {}'.format('mode', 'tickers', 'tickers/s', 'p50 s', 'p99 s',
+                                                              'seconds', 'api calls'))
+    failed = False
+    for mode in args.modes:
+        summary = run_mode(mode, args, config)
+        if summary is None:
+            failed = True
+            continue
+        latencies = summary['latencies']
+        p50, p99 = np.percentile(latencies, [50, 99]) if len(latencies) > 0 else (np.nan, np.nan)
+        calls = ' '.join('{}={}'.format(host, n) for host, n in sorted(summary['requests'].items()))
+        print('{:<12} {:>7} {:>9.2f} {:>10.3f} {:>10.3f} {:>10.2f}  {}'.format(
+            mode, summary['tickers'], summary['tickers'] / summary['seconds'], p50, p99, summary['seconds'], calls))
+
+        if args.spawn > 0:
+            # the workers do the scraping, so the coordinator has no per ticker times or calls of its own
+            spawned = run_mode(mode, args, config, args.spawn)
+            if spawned is None:
+                failed = True
+                continue
+            match = spawned['values'] == summary['values']
+            failed |= not match
+            print('{:<12} {:>7} {:>9} {:>10} {:>10} {:>10.2f}  {}'.format(
+                '  spawn ' + str(args.spawn), '', '', '', '', spawned['seconds'],
+                'same values' if match else 'DIFFERENT values'))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,42 @@
+import watchlist_update as wu
+
+
+def item(key):
+    return lambda result: result.get(key, '')
+
+
+FIELDS = [wu.Field('name', 'E', 'basic', ('yahoo', item('name'), None), ('finviz', item('Company'), None)),
+          wu.Field('sector', 'H', 'basic', ('finviz', item('Sector'), None), ('yahoo', item('sector'), None)),
+          wu.Field('cik', 'G', 'basic', (None, lambda ticker, ciks: ciks.get(ticker, ''), None))]
+
+
+def fill(results, ciks=None):
+    return wu.fill_record(wu.TickerRecord('AAA', 3), FIELDS, results, ciks or {})
+
+
+def test_first_source_wins():
+    record = fill({'yahoo': {'name': 'A Inc', 'sector': 'Tech'}, 'finviz': {'Company': 'A', 'Sector': 'Technology'}},
+                  {'AAA': '123'})
+    assert (record.name, record.sector, record.cik) == ('A Inc', 'Technology', '123')
+
+
+def test_blank_value_falls_back_to_next_source():
+    record = fill({'yahoo': {'name': '', 'sector': 'Tech'}, 'finviz': {'Company': 'A', 'Sector': ''}})
+    assert (record.name, record.sector) == ('A', 'Tech')
+
+
+def test_sources_not_fetched_are_skipped():
+    record = fill({'finviz': {'Company': 'A', 'Sector': ''}})
+    assert (record.name, record.sector) == ('A', '')
+
+
+def test_blank_when_nothing_matches():
+    record = fill({})
+    assert list(record.items()) == [('name', ''), ('cik', ''), ('sector', '')]
+
+
+def test_normaliser_runs_on_the_step_that_matched():
+    field = wu.Field('roa', 'BN', 'fundamental', ('yahoo_stats', item('roa'), None), ('finviz', item('ROA'), 'nan'))
+    record = wu.fill_record(wu.TickerRecord('AAA', 3), [field], {'yahoo_stats': {'roa': ''},
+                                                                  'finviz': {'ROA': '-'}}, {})
+    assert record.roa == wu.check_nan('-')
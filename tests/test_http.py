@@ -0,0 +1,93 @@
+from types import SimpleNamespace
+
+import watchlist_update as wu
+
+
+def page(body, **headers):
+    return SimpleNamespace(headers=headers, status_code=200, content=body)
+
+
+def test_cache_returns_what_was_put(tmp_path):
+    cache = wu.ResponseCache(str(tmp_path / 'cache.sqlite'), 1024, 3600)
+    cache.put('http://a/1', page(b'one', ETag='"e1"', **{'Last-Modified': 'yesterday'}))
+    cached = cache.get('http://a/1')
+    assert (cached['status'], cached['body'], cached['etag'], cached['last_modified']) == \
+        (200, b'one', '"e1"', 'yesterday')
+    assert cache.get('http://a/2') is None
+    cache.close()
+
+
+def test_cache_evicts_expired_pages(tmp_path):
+    cache = wu.ResponseCache(str(tmp_path / 'cache.sqlite'), 1024, 3600)
+    cache.put('http://a/old', page(b'old'))
+    cache.put('http://a/new', page(b'new'))
+    cache.db.execute('UPDATE responses SET fetched = fetched - 7200 WHERE url = ?', ('http://a/old',))
+    cache.evict()
+    assert cache.get('http://a/old') is None
+    assert cache.get('http://a/new') is not None
+    cache.close()
+
+
+def test_cache_evicts_oldest_pages_over_the_size_limit(tmp_path):
+    cache = wu.ResponseCache(str(tmp_path / 'cache.sqlite'), 10, 3600)
+    for i, url in enumerate(['http://a/1', 'http://a/2', 'http://a/3']):
+        cache.put(url, page(b'12345'))
+        cache.db.execute('UPDATE responses SET fetched = ? WHERE url = ?', (1e10 + i, url))
+    cache.evict()
+    assert cache.get('http://a/1') is None
+    assert cache.get('http://a/2') is not None
+    assert cache.get('http://a/3') is not None
+    cache.close()
+
+
+def test_touched_page_survives_expiry(tmp_path):
+    cache = wu.ResponseCache(str(tmp_path / 'cache.sqlite'), 1024, 3600)
+    cache.put('http://a/1', page(b'one'))
+    cache.db.execute('UPDATE responses SET fetched = fetched - 7200')
+    cache.touch('http://a/1')
+    cache.evict()
+    assert cache.get('http://a/1') is not None
+    cache.close()
+
+
+def fake_clock(monkeypatch):
+    # sleeping moves the clock on instead of waiting
+    clock = {'now': 1000., 'waits': []}
+
+    def sleep(wait):
+        clock['waits'].append(wait)
+        clock['now'] += wait
+
+    monkeypatch.setattr(wu, 'monotonic', lambda: clock['now'])
+    monkeypatch.setattr(wu, 'sleep', sleep)
+    return clock
+
+
+def test_rate_limiter_allows_a_burst_then_waits(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    limiter = wu.RateLimiter(2., 3)
+    for i in range(3):
+        limiter.acquire()
+    assert clock['waits'] == []
+    limiter.acquire()
+    assert clock['waits'] == [0.5]
+
+
+def test_rate_limiter_backs_off_and_recovers(monkeypatch):
+    clock = fake_clock(monkeypatch)
+    limiter = wu.RateLimiter(2., 3)
+    limiter.backoff(retry_after=5.)
+    assert limiter.rate == 1.
+    limiter.acquire()
+    # paused for as long as the server asked, tokens build back up in the meantime
+    assert clock['waits'] == [5.]
+    limiter.tokens = 0.
+    limiter.acquire()
+    assert clock['waits'] == [5., 1.]
+
+    for i in range(10):
+        limiter.backoff()
+    assert limiter.rate == 2. / 16.
+    for i in range(100):
+        limiter.recover()
+    assert limiter.rate == 2.
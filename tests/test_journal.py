@@ -0,0 +1,78 @@
+import json
+
+import watchlist_update as wu
+
+
+def open_journal(tmp_path):
+    return wu.Journal(str(tmp_path / 'journal.jsonl'), legacy=str(tmp_path / 'prior_tickers.csv'))
+
+
+def test_resume_after_torn_line(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.start(['--all'])
+    journal.scraped('AAA', [('B3', 1.5)])
+    journal.written(['AAA'])
+    journal.close()
+    # killed half way through an entry
+    with open(str(tmp_path / 'journal.jsonl'), 'a') as file:
+        file.write('{"event": "scraped", "run": "x", "tick')
+
+    journal = open_journal(tmp_path)
+    run, args, scraped, written, finished = journal.unfinished()
+    assert args == ['--all']
+    assert scraped == {'AAA': [('B3', 1.5)]}
+    assert written == {'AAA'}
+
+    journal.start(['--basic'])
+    journal.written(['BBB'])
+    journal.finish()
+    journal.close()
+
+    journal = open_journal(tmp_path)
+    assert journal.unfinished() is None
+    assert journal.known == {'AAA', 'BBB'}
+    journal.close()
+    # the new run starts on its own line after the torn one
+    lines = open(str(tmp_path / 'journal.jsonl')).read().splitlines()
+    assert [json.loads(line)['event'] for line in lines[4:]] == ['start', 'written', 'finished']
+
+def test_written_by_earlier_runs_is_known(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.start(['--all'])
+    journal.written(['AAA'])
+    journal.close()
+
+    journal = open_journal(tmp_path)
+    journal.start(['--all'])
+    journal.written(['BBB'])
+    journal.close()
+
+    journal = open_journal(tmp_path)
+    assert journal.known == {'AAA', 'BBB'}
+    assert journal.unfinished()[3] == {'BBB'}
+    journal.close()
+
+
+def test_compacted_journal_keeps_known(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.start(['--all'])
+    journal.written(['AAA', 'BBB'])
+    journal.finish()
+    journal.compact()
+    journal.start(['--all'])
+    journal.written(['CCC'])
+    journal.close()
+
+    journal = open_journal(tmp_path)
+    assert journal.known == {'AAA', 'BBB', 'CCC'}
+    assert journal.unfinished()[3] == {'CCC'}
+    journal.close()
+
+
+def test_reads_tickers_from_before_the_journal(tmp_path):
+    with open(str(tmp_path / 'prior_tickers.csv'), 'w') as file:
+        file.write('0,AAA\n1,BBB\n')
+    journal = open_journal(tmp_path)
+    assert journal.known == {'AAA', 'BBB'}
+    assert journal.unfinished() is None
+    journal.close()
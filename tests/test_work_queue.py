@@ -0,0 +1,74 @@
+import watchlist_update as wu
+
+
+def make_queue(tmp_path, lease=300., max_attempts=3):
+    return wu.WorkQueue(str(tmp_path / 'queue.sqlite'), lease, max_attempts)
+
+
+def test_leases_in_row_order_and_returns_results(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.fill([('BBB', 4), ('AAA', 3)], {'fields': ['name']})
+    assert queue.take_lease('w1') == ('AAA', 3)
+    assert queue.take_lease('w2') == ('BBB', 4)
+    assert queue.take_lease('w1') is None
+    assert queue.outstanding() == 2
+
+    queue.complete('AAA', 'w1', [('B3', 1.5)])
+    # only the worker holding the lease can complete it
+    queue.complete('BBB', 'w1', [('B4', 2.5)])
+    assert queue.take_results() == [('AAA', [('B3', 1.5)])]
+    assert queue.take_results() == []
+    assert queue.outstanding() == 1
+    queue.close()
+
+
+def test_expired_lease_is_handed_out_again(tmp_path):
+    queue = make_queue(tmp_path, lease=-1.)
+    queue.fill([('AAA', 3)], {})
+    assert queue.take_lease('w1') == ('AAA', 3)
+    assert queue.take_lease('w2') == ('AAA', 3)
+    # the first worker lost its lease
+    queue.complete('AAA', 'w1', [('B3', 1.)])
+    assert queue.take_results() == []
+    queue.complete('AAA', 'w2', [('B3', 2.)])
+    assert queue.take_results() == [('AAA', [('B3', 2.)])]
+    queue.close()
+
+
+def test_gives_up_after_max_attempts(tmp_path):
+    queue = make_queue(tmp_path, max_attempts=2)
+    queue.fill([('AAA', 3)], {})
+    queue.take_lease('w1')
+    queue.fail('AAA', 'w1', 'boom')
+    assert queue.outstanding() == 1
+    queue.take_lease('w1')
+    queue.fail('AAA', 'w1', 'boom again')
+    assert queue.take_lease('w1') is None
+    assert queue.outstanding() == 0
+    assert queue.failed() == [('AAA', 'boom again')]
+    queue.close()
+
+
+def test_workers_use_the_coordinators_limits(tmp_path):
+    coordinator = make_queue(tmp_path, lease=60., max_attempts=5)
+    coordinator.fill([('AAA', 3)], {'fields': ['name']})
+    meta = coordinator.meta()
+    assert meta['fields'] == ['name']
+    assert (meta['lease'], meta['max_attempts']) == (60., 5)
+    coordinator.close()
+
+
+def test_outstanding_matches_what_can_be_leased(tmp_path):
+    # a queue filled with more attempts than this process allows
+    queue = make_queue(tmp_path, max_attempts=5)
+    queue.fill([('AAA', 3)], {})
+    for n in range(3):
+        queue.take_lease('w1')
+        queue.fail('AAA', 'w1', 'boom')
+    queue.close()
+
+    queue = make_queue(tmp_path, max_attempts=3)
+    assert queue.take_lease('w1') is None
+    assert queue.outstanding() == 0
+    assert queue.failed() == [('AAA', 'boom')]
+    queue.close()
@@ -0,0 +1,45 @@
+import watchlist_update as wu
+
+
+def test_single_cell_range():
+    assert wu.grid_ranges({(3, 2): 'x'}) == [{'range': 'B3', 'values': [['x']]}]
+
+
+def test_row_runs_split_on_gaps():
+    grid = {(3, 2): 1, (3, 3): 2, (3, 4): 3, (3, 6): 4}
+    assert wu.grid_ranges(grid) == [{'range': 'B3:D3', 'values': [[1, 2, 3]]},
+                                    {'range': 'F3', 'values': [[4]]}]
+
+
+def test_same_columns_on_consecutive_rows_stack():
+    grid = {(3, 2): 1, (3, 3): 2, (4, 2): 3, (4, 3): 4, (6, 2): 5, (6, 3): 6}
+    assert wu.grid_ranges(grid) == [{'range': 'B3:C4', 'values': [[1, 2], [3, 4]]},
+                                    {'range': 'B6:C6', 'values': [[5, 6]]}]
+
+
+def test_same_cell_compares_unformatted_values():
+    assert wu.same_cell('12.34%', 0.1234)
+    assert wu.same_cell('1,234', 1234)
+    assert wu.same_cell('$5.5', '5.5')
+    assert wu.same_cell('AAPL', 'AAPL')
+    assert wu.same_cell(None, '')
+    assert not wu.same_cell('1.2345', 1.23)
+    assert not wu.same_cell('AAPL', 'MSFT')
+    assert not wu.same_cell('', 0)
+
+
+def test_plan_writes_drops_cells_the_sheet_has():
+    snapshot = {(3, 2): 1.5, (3, 3): 'same', (4, 2): 7}
+    calls = [('B3', '1.5'), ('C3', 'same'), ('B4', 8), ('D4', 'new')]
+    assert wu.plan_writes(calls, snapshot) == ([('B4', 8), ('D4', 'new')], 2)
+
+
+def test_plan_writes_keeps_a_record_with_only_changed_fields():
+    record = wu.TickerRecord('AAA', 5)
+    record.name = 'Company A'
+    record.sector = 'Tech'
+    snapshot = {(5, wu.col_to_num(wu.FIELD_COLUMNS['name'])): 'Company A'}
+    narrowed, skipped = wu.plan_writes(record, snapshot)
+    assert skipped == 1
+    assert isinstance(narrowed, wu.TickerRecord)
+    assert list(narrowed.items()) == [('sector', 'Tech')]
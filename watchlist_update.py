@@ -1,33 +1,238 @@
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-import numpy as np
-import requests
-from lxml import html
-import pandas as pd
-import yfinance as yf
-from time import sleep
-from finvizfinance.quote import finvizfinance
+from time import sleep, monotonic
 import datetime as dt
 import argparse
 import sys
-from bs4 import BeautifulSoup
 import yaml
+import json
+import os
+import threading
+import subprocess
+import socket
+import queue
+import sqlite3
+import hashlib
+import random
+import base64
+import csv
+import importlib
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+class LazyModule:
+    # stands in for a heavy module until it's first used, so --help and narrow runs don't import what they
+    # never touch. Once loaded the module replaces this in the globals
+
+    def __init__(self, alias, name):
+        object.__setattr__(self, '_lazy_module', (alias, name))
+
+    def _lazy_load(self):
+        alias, name = object.__getattribute__(self, '_lazy_module')
+        with timed('import', name):
+            module = importlib.import_module(name)
+        globals()[alias] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._lazy_load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._lazy_load(), attr, value)
+
+
+gspread = LazyModule('gspread', 'gspread')
+np = LazyModule('np', 'numpy')
+requests = LazyModule('requests', 'requests')
+html = LazyModule('html', 'lxml.html')
+pd = LazyModule('pd', 'pandas')
+yf = LazyModule('yf', 'yfinance')
+finviz_quote = LazyModule('finviz_quote', 'finvizfinance.quote')
+
+# max concurrent requests to each host, can be overridden with host_limits in config.yaml
+HOST_LIMITS = {'yahoo': 2,
+               'finviz': 1,
+               'whalewisdom': 1,
+               'openinsider': 1,
+               'stocksearning': 1
+               }
+host_semaphores = {}
+
+# requests per second and burst size for each host, can be overridden with rate_limits in config.yaml
+RATE_LIMITS = {'sheets': {'rate': 1.0, 'burst': 5},
+               'yahoo': {'rate': 2.0, 'burst': 4},
+               'finviz': {'rate': 1.0, 'burst': 2},
+               'whalewisdom': {'rate': 0.5, 'burst': 1},
+               'openinsider': {'rate': 1.0, 'burst': 2},
+               'stocksearning': {'rate': 1.0, 'burst': 2}
+               }
+rate_limiters = {}
+rate_lock = threading.Lock()
+# times to retry a sheets call that was rate limited
+MAX_RETRIES = 5
+
+# attempts per request and jittered exponential backoff between them for each host, can be overridden with
+# retries in config.yaml
+RETRY_POLICY = {host: {'attempts': 3, 'backoff': 1.0, 'max_backoff': 30.}
+                for host in ['yahoo', 'finviz', 'whalewisdom', 'openinsider', 'stocksearning']}
+# failed requests in a row before a host is left alone for cooldown seconds, can be overridden with
+# circuit_breaker in config.yaml
+BREAKER_LIMITS = {host: {'failures': 5, 'cooldown': 120.}
+                  for host in ['yahoo', 'finviz', 'whalewisdom', 'openinsider', 'stocksearning']}
+breakers = {}
+# seconds to wait for a response, set with http_timeout in config.yaml
+HTTP_TIMEOUT = 15
+
+# seconds to reuse cached pages for each host, can be overridden with cache_ttl in config.yaml
+CACHE_TTL = {'yahoo': 12 * 3600,
+             'finviz': 12 * 3600,
+             'whalewisdom': 7 * 86400,
+             'openinsider': 86400,
+             'stocksearning': 86400
+             }
+# size and age limits for the whole cache
+CACHE_MAX_MB = 500
+CACHE_MAX_DAYS = 30
+http_cache = None
+
+# seconds before each source is fetched again in an incremental run, can be overridden with
+# source_refresh in config.yaml
+SOURCE_REFRESH = {'yahoo': 86400,
+                  'yahoo_stats': 86400,
+                  'yahoo_growth': 86400,
+                  'finviz': 86400,
+                  'whales': 7 * 86400,
+                  'insiders': 86400,
+                  'updown': 12 * 3600,
+                  'earnings': 86400
+                  }
+state_store = None
+
+# pages scraped for each ticker
+YAHOO_STATS_URL = 'https://uk.finance.yahoo.com/quote/{0}/key-statistics?p={0}'
+YAHOO_ANALYSIS_URL = 'https://uk.finance.yahoo.com/quote/{0}/analysis?p={0}'
+OPENINSIDER_URL = 'http://www.openinsider.com/screener?s={}&o=&pl=&ph=&ll=&lh=&fd=365&fdr=&td=0&tdr=&fdlyl=&' \
+                  'fdlyh=&daysago=&xp=1&vl=&vh=&ocl=&och=&sic1=-1&sicl=100&sich=9999&grp=0&nfl=&nfh=&nil=&nih=&' \
+                  'nol=&noh=&v2l=&v2h=&oc2l=&oc2h=&sortcol=0&cnt=100&page=1'
+YAHOO_HEADERS = {"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:88.0) Gecko/20100101 Firefox/88.0"}
+# finviz screener for a list of tickers with the chosen columns, shows 20 tickers a page
+FINVIZ_SCREENER_URL = 'https://finviz.com/screener.ashx?v=152&t={}&c={}'
+# screener column ids for the quote page values the fields use
+FINVIZ_SCREENER_COLUMNS = {'Ticker': 1,
+                           'EPS this Y': 17,
+                           'EPS next Y': 18,
+                           'EPS past 5Y': 19,
+                           'EPS next 5Y': 20,
+                           'Sales past 5Y': 21,
+                           'EPS Q/Q': 22,
+                           'Sales Q/Q': 23,
+                           'ROA': 32,
+                           'ROE': 33,
+                           'Gross Margin': 39
+                           }
+# screener headers that aren't the same as the quote page
+FINVIZ_SCREENER_HEADERS = {'Gross M': 'Gross Margin'}
+
+# domains for each host, used to pick the shared session for a url
+HOST_DOMAINS = {'finance.yahoo.com': 'yahoo',
+                'finviz.com': 'finviz',
+                'whalewisdom.com': 'whalewisdom',
+                'openinsider.com': 'openinsider',
+                'stocksearning.com': 'stocksearning'
+                }
+# one keep-alive session per host
+sessions = {}
+session_lock = threading.Lock()
 
 def get_watchlist_tickers(gsheet_url):
     # set gsheets creds
-    gc = gspread.service_account(filename='gsheets-py.json')
+    if replay['mode'] == 'replay':
+        maintable = ReplaySheet(replay['dir'], replay['latency'])
+    else:
+        gc = gspread.service_account(filename='gsheets-py.json')
+
+        # url of watchlist
+        gsheet = gc.open_by_url(gsheet_url)
 
-    # url of watchlist
-    gsheet = gc.open_by_url(gsheet_url)
+        # open main table with all data in
+        maintable = gsheet.worksheet("Table")
+        if replay['mode'] == 'record':
+            maintable = RecordingSheet(maintable, replay['dir'])
 
-    # open main table with all data in
-    maintable = gsheet.worksheet("Table")
+    # read the whole table in one call. Unformatted, so numbers come back as they're stored and not rounded to
+    # the cell's number format, which would make a changed value look like it's already there
+    values = sheet_call(maintable.get_all_values, value_render_option='UNFORMATTED_VALUE')
 
     # get tickers
-    tickers = maintable.col_values(1)[2:]
+    tickers = [str(r[0]) if len(r) > 0 else '' for r in values[2:]]
+    # trailing empty rows
+    while (len(tickers) > 0) and (tickers[-1] == ''):
+        tickers.pop()
     #print(tickers)
 
-    return maintable, tickers
+    return maintable, tickers, sheet_snapshot(values)
+
+
+def sheet_snapshot(values):
+    # current contents of the sheet as {(row, col): value}, both 1-based. Values are text or numbers
+    snapshot = {}
+    for r, row_values in enumerate(values):
+        for c, val in enumerate(row_values):
+            if val != '':
+                snapshot[(r + 1, c + 1)] = val
+
+    return snapshot
+
+
+def cell_number(val):
+    # number in a cell, or None if it isn't one
+    if isinstance(val, bool):
+        return None
+    if isinstance(val, (int, float)):
+        return float(val)
+    text = str(val).strip().replace(',', '').replace('$', '')
+    if text.endswith('%'):
+        # the sheet keeps 12.34% as 0.1234, multiplying by 0.01 can be a bit off from that
+        text = text[:-1] + 'e-2'
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def same_cell(new, old):
+    # does the sheet already have this value, old is the unformatted value from the sheet
+    new = clean_value(new)
+    if str(new) == old:
+        return True
+    new_num, old_num = cell_number(new), cell_number(old)
+    if (new_num is None) or (old_num is None):
+        return False
+    return new_num == old_num
+
+
+def plan_writes(api_calls, snapshot):
+    # drop writes the sheet already has, returns the writes to send and how many were skipped
+    changed = []
+    total = 0
+    for row, col, field, val in calls_by_field(api_calls):
+        total += 1
+        if not same_cell(val, snapshot.get((row, col_to_num(col)), '')):
+            changed.append((row, col, field, val))
+
+    return narrow_calls(api_calls, changed), total - len(changed)
+
+
+def ticker_rows(tickers):
+    # row in the sheet for each ticker, first one wins if a ticker is in there twice
+    rows = {}
+    for i, ticker in enumerate(tickers):
+        if (ticker != '') and (ticker not in rows):
+            rows[ticker] = i + 3
+
+    return rows
 
 
 def check_round(val):
@@ -46,6 +251,131 @@ def check_round(val):
     return np.round(val, 2)
 
 
+def col_to_num(col):
+    # sheet column letters to 1-based index, e.g. 'AB' -> 28
+    num = 0
+    for c in col:
+        num = num * 26 + (ord(c.upper()) - ord('A') + 1)
+    return num
+
+
+def num_to_col(num):
+    # 1-based index to sheet column letters, e.g. 28 -> 'AB'
+    col = ''
+    while num > 0:
+        num, rem = divmod(num - 1, 26)
+        col = chr(ord('A') + rem) + col
+    return col
+
+
+def split_cell(cell):
+    # 'AB12' -> ('AB', 12)
+    col = cell.rstrip('0123456789')
+    return col, int(cell[len(col):])
+
+
+def calls_by_field(api_calls):
+    # (row, col, field, value) for each update, records give them without making and splitting cell names
+    if isinstance(api_calls, TickerRecord):
+        for name, val in api_calls.items():
+            yield api_calls.row, FIELD_COLUMNS[name], name, val
+    else:
+        for cell, val in api_calls:
+            col, row = split_cell(cell)
+            yield row, col, COLUMN_FIELDS.get(col, col), val
+
+
+def narrow_calls(api_calls, changed):
+    # the changed (row, col, field, value) updates, a record keeps its form with the other slots cleared and
+    # (cell, value) updates stay as cells
+    if isinstance(api_calls, TickerRecord):
+        return api_calls.keep([field for row, col, field, val in changed])
+    return [(col + str(row), val) for row, col, field, val in changed]
+
+
+def clean_value(val):
+    # numpy types and None can't be sent through the sheets api
+    if val is None:
+        return ''
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+
+def calls_to_grid(api_calls, grid=None):
+    # (cell, value) updates to a {(row, col): value} grid
+    if grid is None:
+        grid = {}
+    for row, col, field, val in calls_by_field(api_calls):
+        grid[(row, col_to_num(col))] = clean_value(val)
+    return grid
+
+
+def grid_ranges(grid):
+    # split each row into contiguous column runs, then stack runs covering the
+    # same columns on consecutive rows into one block range
+    rows = {}
+    for (row, col), val in grid.items():
+        rows.setdefault(row, {})[col] = val
+
+    blocks = []
+    open_blocks = {}
+    for row in sorted(rows):
+        cols = sorted(rows[row])
+        runs = []
+        for col in cols:
+            if len(runs) > 0 and runs[-1][1] == col - 1:
+                runs[-1][1] = col
+            else:
+                runs.append([col, col])
+
+        for start, end in runs:
+            values = [rows[row][col] for col in range(start, end + 1)]
+            block = open_blocks.get((start, end))
+            if block is not None and block[3] == row - 1:
+                block[3] = row
+                block[4].append(values)
+            else:
+                block = [start, end, row, row, [values]]
+                blocks.append(block)
+                open_blocks[(start, end)] = block
+
+    data = []
+    for start, end, first, last, values in blocks:
+        if (start == end) and (first == last):
+            rng = num_to_col(start) + str(first)
+        else:
+            rng = num_to_col(start) + str(first) + ':' + num_to_col(end) + str(last)
+        data.append({'range': rng, 'values': values})
+
+    return data
+
+
+def push_updates(maintable, api_calls=None, grid=None):
+    # send all updates in a single batch_update call
+    if grid is None:
+        grid = calls_to_grid(api_calls)
+    data = grid_ranges(grid)
+    if len(data) == 0:
+        return 0
+
+    try:
+        sheet_call(maintable.batch_update, data, value_input_option='USER_ENTERED')
+    except Exception as e:
+        # fall back to range by range so one bad value doesn't lose the whole batch
+        print('Batch push error: ', e)
+        for d in data:
+            try:
+                sheet_call(maintable.update, d['range'], [[str(v) for v in vals] for vals in d['values']],
+                           value_input_option='USER_ENTERED')
+            except Exception as e:
+                print('Data push error: ', e)
+                print('Skipping call for: ', d['range'], d['values'])
+        return len(data)
+
+    return 1
+
+
 def check_nan(val):
 
     if isinstance(val, str):
@@ -93,6 +423,576 @@ def unit_convert(val):
     return float(val)
 
 
+# seconds spent in each stage of the run, by host or source
+stage_times = {}
+timing_lock = threading.Lock()
+
+
+def add_timing(stage, host, seconds):
+    with timing_lock:
+        stage_times.setdefault((stage, host), []).append(seconds)
+
+
+@contextmanager
+def timed(stage, host=''):
+    start = monotonic()
+    try:
+        yield
+    finally:
+        add_timing(stage, host, monotonic() - start)
+
+
+def timing_summary():
+    # total, mean and p95 seconds for each stage and host
+    # copy first, numpy may not be imported yet and timing its import takes the lock
+    with timing_lock:
+        stages = sorted((key, list(times)) for key, times in stage_times.items())
+
+    rows = []
+    for (stage, host), times in stages:
+        times = np.array(times)
+        rows.append({'stage': stage, 'host': host, 'count': len(times), 'total': float(times.sum()),
+                     'mean': float(times.mean()), 'p95': float(np.percentile(times, 95))})
+    return rows
+
+
+def print_timings(rows):
+
+    print('{:<10} {:<15} {:>6} {:>10} {:>9} {:>9}'.format('stage', 'host', 'count', 'total s', 'mean s', 'p95 s'))
+    for r in rows:
+        print('{:<10} {:<15} {:>6} {:>10.2f} {:>9.3f} {:>9.3f}'.format(r['stage'], r['host'], r['count'],
+                                                                       r['total'], r['mean'], r['p95']))
+
+
+def save_metrics(path, rows, counts):
+    # prometheus textfile if the name ends in .prom, otherwise json
+    if path.endswith('.prom'):
+        lines = ['# HELP watchlist_stage_seconds Time spent in each stage of the last run',
+                 '# TYPE watchlist_stage_seconds summary']
+        for r in rows:
+            labels = 'stage="{}",host="{}"'.format(r['stage'], r['host'])
+            lines.append('watchlist_stage_seconds{{{},quantile="0.95"}} {}'.format(labels, r['p95']))
+            lines.append('watchlist_stage_seconds_sum{{{}}} {}'.format(labels, r['total']))
+            lines.append('watchlist_stage_seconds_count{{{}}} {}'.format(labels, r['count']))
+        lines += ['# HELP watchlist_api_calls API calls made to each host in the last run',
+                  '# TYPE watchlist_api_calls gauge']
+        for host, n in sorted(counts.items()):
+            lines.append('watchlist_api_calls{{host="{}"}} {}'.format(host, n))
+        text = '\n'.join(lines) + '\n'
+    else:
+        text = json.dumps({'stages': rows, 'api_calls': counts}, indent=1)
+
+    # node exporter can read the file at any time so swap it in whole
+    with open(path + '.tmp', 'w') as file:
+        file.write(text)
+    os.replace(path + '.tmp', path)
+
+
+class RateLimiter:
+    # token bucket for one host, slows down on 429s and speeds back up on success
+
+    def __init__(self, rate, burst):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.last = monotonic()
+        self.blocked_until = 0.
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def backoff(self, retry_after=None):
+        # halve the rate and pause the host, for as long as the server asked if it did
+        with self.lock:
+            self.rate = max(self.max_rate / 16., self.rate / 2.)
+            self.tokens = 0.
+            if retry_after is None:
+                retry_after = 1. / self.rate
+            self.blocked_until = max(self.blocked_until, monotonic() + retry_after)
+
+    def recover(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate * 1.1)
+
+
+def set_rate_limits(limits):
+
+    for host, limit in limits.items():
+        RATE_LIMITS[host] = dict(RATE_LIMITS.get(host, {}), **limit)
+    with rate_lock:
+        rate_limiters.clear()
+
+
+def get_rate_limiter(host):
+
+    with rate_lock:
+        if host not in rate_limiters:
+            limit = RATE_LIMITS.get(host, {'rate': 1.0, 'burst': 1})
+            rate_limiters[host] = RateLimiter(limit['rate'], limit['burst'])
+
+    return rate_limiters[host]
+
+
+def rate_limit(host):
+    # wait for a free slot for this host
+    with timed('ratelimit', host):
+        get_rate_limiter(host).acquire()
+
+
+def retry_after_seconds(value):
+    # Retry-After can be a number of seconds or a http date
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., (parsedate_to_datetime(value) - dt.datetime.now(dt.timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
+
+class FetchError(Exception):
+    # a host couldn't be reached after retrying, or its circuit is open
+    pass
+
+
+class CircuitBreaker:
+    # stops calling a host after too many failures in a row, then lets one call through after the cooldown
+
+    def __init__(self, host, failures, cooldown):
+        self.host = host
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if monotonic() - self.opened >= self.cooldown:
+                # trial call, everything else waits for another cooldown unless it works
+                self.opened = monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def remaining(self):
+        # seconds until a trial call is let through
+        with self.lock:
+            if self.opened is None:
+                return 0.
+            return max(0., self.cooldown - (monotonic() - self.opened))
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                if self.opened is None:
+                    print('Too many failures from', self.host, 'stopping requests for', self.cooldown, 'seconds')
+                self.opened = monotonic()
+
+
+def set_retry_policy(retries, limits, timeout=None):
+
+    global HTTP_TIMEOUT
+    for host, policy in retries.items():
+        RETRY_POLICY[host] = dict(RETRY_POLICY.get(host, {'attempts': 3, 'backoff': 1.0, 'max_backoff': 30.}),
+                                  **policy)
+    for host, limit in limits.items():
+        BREAKER_LIMITS[host] = dict(BREAKER_LIMITS.get(host, {'failures': 5, 'cooldown': 120.}), **limit)
+    if timeout is not None:
+        HTTP_TIMEOUT = timeout
+    with rate_lock:
+        breakers.clear()
+
+
+def get_breaker(host):
+
+    with rate_lock:
+        if host not in breakers:
+            limit = BREAKER_LIMITS.get(host, {'failures': 5, 'cooldown': 120.})
+            breakers[host] = CircuitBreaker(host, limit['failures'], limit['cooldown'])
+
+    return breakers[host]
+
+
+def retry_delay(host, attempt):
+    # full jitter so threads that failed together don't retry together
+    policy = RETRY_POLICY.get(host, {'backoff': 1.0, 'max_backoff': 30.})
+    return random.uniform(0, min(policy['max_backoff'], policy['backoff'] * 2 ** attempt))
+
+
+def guarded(host, func, *args, **kwargs):
+    # call a library that talks to host, retrying network errors and going through the host's circuit breaker
+    breaker = get_breaker(host)
+    attempts = RETRY_POLICY.get(host, {'attempts': 1})['attempts']
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise FetchError('{} is failing, skipped'.format(host))
+        try:
+            result = func(*args, **kwargs)
+        except requests.RequestException as e:
+            breaker.failure()
+            if (attempt == attempts - 1) or (breaker.remaining() > 0):
+                raise FetchError('{} failed: {}'.format(host, e))
+            sleep(retry_delay(host, attempt))
+            continue
+        breaker.success()
+        return result
+
+
+def sheet_call(func, *args, **kwargs):
+    # rate limited call to the sheets api, backing off when over quota
+    limiter = get_rate_limiter('sheets')
+    for attempt in range(MAX_RETRIES):
+        with timed('ratelimit', 'sheets'):
+            limiter.acquire()
+        count_request('sheets')
+        try:
+            with timed('sheets', func.__name__):
+                result = func(*args, **kwargs)
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            if (response is not None) and (getattr(response, 'status_code', None) == 429) \
+                    and (attempt < MAX_RETRIES - 1):
+                print('Sheets rate limited, backing off')
+                limiter.backoff(retry_after_seconds(response.headers.get('Retry-After')))
+                continue
+            raise
+        limiter.recover()
+        return result
+
+
+class ResponseCache:
+    # sqlite backed cache of page responses keyed by url
+
+    def __init__(self, path, max_bytes, max_age):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, status INTEGER, headers TEXT, '
+                        'body BLOB, etag TEXT, last_modified TEXT, fetched REAL, size INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_fetched ON responses (fetched)')
+        self.db.commit()
+
+    def get(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT status, headers, body, etag, last_modified, fetched FROM responses '
+                                  'WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        return {'url': url, 'status': row[0], 'headers': json.loads(row[1]), 'body': row[2],
+                'etag': row[3], 'last_modified': row[4], 'fetched': row[5]}
+
+    def put(self, url, response):
+        headers = dict(response.headers)
+        with self.lock:
+            self.db.execute('REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (url, response.status_code, json.dumps(headers), response.content,
+                             headers.get('ETag'), headers.get('Last-Modified'), dt.datetime.now().timestamp(),
+                             len(response.content)))
+            self.db.commit()
+
+    def touch(self, url):
+        # page hasn't changed, so it's fresh again
+        with self.lock:
+            self.db.execute('UPDATE responses SET fetched = ? WHERE url = ?', (dt.datetime.now().timestamp(), url))
+            self.db.commit()
+
+    def evict(self):
+        # drop anything too old, then the oldest pages until under the size limit
+        with self.lock:
+            self.db.execute('DELETE FROM responses WHERE fetched < ?',
+                            (dt.datetime.now().timestamp() - self.max_age,))
+            total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total > self.max_bytes:
+                for url, size in self.db.execute('SELECT url, size FROM responses ORDER BY fetched').fetchall():
+                    self.db.execute('DELETE FROM responses WHERE url = ?', (url,))
+                    total -= size
+                    if total <= self.max_bytes:
+                        break
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_cache(cache_dir, config):
+
+    CACHE_TTL.update(config.get('cache_ttl', {}))
+    os.makedirs(cache_dir, exist_ok=True)
+    cache = ResponseCache(os.path.join(cache_dir, 'http_cache.sqlite'),
+                          config.get('cache_max_mb', CACHE_MAX_MB) * 1024 * 1024,
+                          config.get('cache_max_days', CACHE_MAX_DAYS) * 86400)
+    cache.evict()
+
+    return cache
+
+
+def cached_response(cached):
+    # rebuild a requests response from a cache entry
+    response = requests.Response()
+    response.status_code = cached['status']
+    response.headers = requests.structures.CaseInsensitiveDict(cached['headers'])
+    response._content = cached['body']
+    response.url = cached['url']
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+
+    return response
+
+
+def url_host(url):
+
+    netloc = urlparse(url).netloc.lower()
+    for domain, host in HOST_DOMAINS.items():
+        if (netloc == domain) or netloc.endswith('.' + domain):
+            return host
+
+    return netloc
+
+
+def get_session(host):
+    # pooled session per host so connections are reused across tickers
+    with session_lock:
+        if host not in sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=HOST_LIMITS.get(host, 1))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            sessions[host] = session
+
+    return sessions[host]
+
+
+# record http responses and sheet reads to disk, or play them back instead of using the network
+replay = {'mode': None, 'dir': None, 'latency': 0.}
+# query parameters that change from run to run, left out when matching a recorded response
+REPLAY_IGNORE_PARAMS = {'period1', 'period2', 'crumb', '_'}
+# api calls made to each host and seconds taken to scrape each ticker
+request_counts = {}
+count_lock = threading.Lock()
+ticker_latencies = []
+
+
+def count_request(host):
+    with count_lock:
+        request_counts[host] = request_counts.get(host, 0) + 1
+
+
+def replay_key(method, url):
+    # file name for a recorded response
+    parts = urlparse(url)
+    query = sorted(q for q in parts.query.split('&') if q.split('=')[0] not in REPLAY_IGNORE_PARAMS)
+    key = '{} {}{}?{}'.format(method, parts.netloc, parts.path, '&'.join(query))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+
+
+class CountingAdapter:
+    # transport used by every requests session, including finvizfinance's, counts the calls made to each host.
+    # Google's are left out, the sheet calls are counted in sheet_call
+
+    def send(self, request, **kwargs):
+        host = url_host(request.url)
+        if not host.endswith('googleapis.com'):
+            count_request(host)
+        return super().send(request, **kwargs)
+
+
+class ReplayAdapter:
+    # transport used by every requests session once replay is set up, including yfinance and finvizfinance
+
+    def send(self, request, **kwargs):
+        path = os.path.join(replay['dir'], replay_key(request.method, request.url))
+
+        if replay['mode'] == 'replay':
+            sleep(replay['latency'])
+            if not os.path.exists(path):
+                print('No recorded response for', request.url)
+                return self.recorded_response(request, {'status': 404, 'headers': {}, 'body': ''})
+            with open(path, 'r') as file:
+                return self.recorded_response(request, json.load(file))
+
+        response = super().send(request, **kwargs)
+        saved = {'url': request.url,
+                 'status': response.status_code,
+                 'headers': dict(response.headers),
+                 'body': base64.b64encode(response.content).decode('ascii')
+                 }
+        # workers may record the same url into the same directory
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as file:
+            json.dump(saved, file)
+        os.replace(tmp, path)
+        return response
+
+    def recorded_response(self, request, saved):
+        response = requests.Response()
+        response.status_code = saved['status']
+        # body is saved already decoded
+        headers = {k: v for k, v in saved['headers'].items() if k.lower() != 'content-encoding'}
+        response.headers = requests.structures.CaseInsensitiveDict(headers)
+        response._content = base64.b64decode(saved['body'])
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.reason = 'Replayed'
+        return response
+
+
+def setup_replay(mode, path, latency=0.):
+    # mode is 'record' or 'replay'. The page cache is turned off, cache hits never reach the transport so
+    # they wouldn't be recorded, and a stale hit would record an empty 304
+    global http_cache
+    http_cache = None
+    os.makedirs(path, exist_ok=True)
+    replay.update({'mode': mode, 'dir': path, 'latency': latency})
+
+
+def setup_transport():
+    # mix the counting, and the recording or replaying if it's set up, into requests' HTTPAdapter so every
+    # session made from now on uses them
+    mixins = (CountingAdapter, ReplayAdapter) if replay['mode'] is not None else (CountingAdapter,)
+    adapter = type('Adapter', mixins + (requests.adapters.HTTPAdapter,), {})
+    requests.adapters.HTTPAdapter = adapter
+    requests.sessions.HTTPAdapter = adapter
+
+
+class RecordingSheet:
+    # worksheet that saves what it read and wrote so the run can be replayed
+
+    def __init__(self, maintable, path):
+        self.maintable = maintable
+        self.path = path
+
+    def get_all_values(self, **kwargs):
+        values = self.maintable.get_all_values(**kwargs)
+        with open(os.path.join(self.path, 'sheet_values.json'), 'w') as file:
+            json.dump(values, file)
+        return values
+
+    def batch_update(self, data, **kwargs):
+        self.save_call('batch_update', data)
+        return self.maintable.batch_update(data, **kwargs)
+
+    def update(self, cell_range, values, **kwargs):
+        self.save_call('update', [{'range': cell_range, 'values': values}])
+        return self.maintable.update(cell_range, values, **kwargs)
+
+    def save_call(self, method, data):
+        with open(os.path.join(self.path, 'sheet_calls.jsonl'), 'a') as file:
+            file.write(json.dumps({'method': method, 'data': data}, default=str) + '\n')
+
+    def __getattr__(self, name):
+        return getattr(self.maintable, name)
+
+
+class ReplaySheet:
+    # stand in for the worksheet, reads come from the recording and writes only wait and get counted
+
+    def __init__(self, path, latency=0.):
+        with open(os.path.join(path, 'sheet_values.json'), 'r') as file:
+            self.values = json.load(file)
+        self.latency = latency
+        self.cells_written = 0
+
+    def get_all_values(self, **kwargs):
+        sleep(self.latency)
+        return [list(r) for r in self.values]
+
+    def batch_update(self, data, **kwargs):
+        sleep(self.latency)
+        self.cells_written += sum(len(r) for d in data for r in d['values'])
+
+    def update(self, cell_range, values, **kwargs):
+        sleep(self.latency)
+        self.cells_written += sum(len(r) for r in values)
+
+
+def http_get(url, headers=None):
+
+    host = url_host(url)
+
+    # use the cached page while it's fresh, otherwise ask the server if it has changed
+    cached = None
+    if http_cache is not None:
+        cached = http_cache.get(url)
+    if cached is not None:
+        if dt.datetime.now().timestamp() - cached['fetched'] < CACHE_TTL.get(host, 0):
+            return cached_response(cached)
+        headers = dict(headers or {})
+        if cached['etag'] is not None:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified'] is not None:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    limiter = get_rate_limiter(host)
+    breaker = get_breaker(host)
+    attempts = RETRY_POLICY.get(host, {'attempts': 1})['attempts']
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise FetchError('{} is failing, skipped {}'.format(host, url))
+        with timed('ratelimit', host):
+            limiter.acquire()
+        response = None
+        try:
+            with timed('http', host):
+                response = get_session(host).get(url, headers=headers, timeout=HTTP_TIMEOUT)
+        except requests.RequestException as e:
+            error = e
+        else:
+            if (response.status_code < 500) and (response.status_code != 429):
+                break
+            error = 'status {}'.format(response.status_code)
+
+        # rate limiting is left to the rate limiter, anything else counts towards opening the circuit
+        rate_limited = (response is not None) and (response.status_code == 429)
+        if not rate_limited:
+            breaker.failure()
+        if (attempt == attempts - 1) or (breaker.remaining() > 0):
+            raise FetchError('{} failed after {} attempts: {}'.format(url, attempt + 1, error))
+        if rate_limited:
+            print('Rate limited by', host, 'backing off')
+            limiter.backoff(retry_after_seconds(response.headers.get('Retry-After')))
+        else:
+            print('Retrying', url, error)
+            sleep(retry_delay(host, attempt))
+
+    breaker.success()
+    limiter.recover()
+
+    if http_cache is not None:
+        if (response.status_code == 304) and (cached is not None):
+            http_cache.touch(url)
+            return cached_response(cached)
+        if response.status_code == 200:
+            http_cache.put(url, response)
+
+    return response
+
+
 def yahoo_data(ticker):
 
     ## yf info dict keys ##
@@ -120,23 +1020,25 @@ def yahoo_data(ticker):
     ## ##
 
     try:
+        rate_limit('yahoo')
         share = yf.Ticker(ticker)
-        info = share.info
-        holders = share.institutional_holders['Holder'].values
+        info = guarded('yahoo', lambda: share.info)
+        holders = guarded('yahoo', lambda: share.institutional_holders)['Holder'].values
         holds = ', '.join([x for x in holders])
         return info, holds
+    except FetchError:
+        raise
     except Exception as e:
         print('error checking ticker: ', ticker, e)
         return {}, ''
 
 
 def yahoo_dict(table):
-
-    rows = table.find_all('tr')
+    # first cell of each row -> the rest of the non empty cells, table is an lxml element
+    rows = list(table.iter('tr'))
     data = []
     for row in rows[1:]:
-        cols = row.find_all('td')
-        cols = [ele.text.strip() for ele in cols]
+        cols = [ele.text_content().strip() for ele in row.iter('td')]
         data.append([ele for ele in cols if ele])
 
     dict = {}
@@ -146,99 +1048,112 @@ def yahoo_dict(table):
     return dict
 
 
+def yahoo_columns(rows, columns):
+    # column -> row label -> value, the same lookups as a DataFrame built from the rows, short rows are
+    # padded with nan and the longest row has to match the columns
+    width = max([len(values) for values in rows.values()], default=len(columns))
+    if width != len(columns):
+        raise ValueError('{} columns passed, passed data had {} columns'.format(len(columns), width))
+
+    table = {col: {} for col in columns}
+    for label, values in rows.items():
+        for i, col in enumerate(columns):
+            table[col][label] = values[i] if i < len(values) else np.nan
+
+    return table
+
+
+def find_table(tree, headers):
+    # header and rows of cell text for the first table that has all the headers
+    for table in tree.iter('table'):
+        rows = [[cell.text_content().replace('\xa0', ' ').strip() for cell in row if cell.tag in ('td', 'th')]
+                for row in table.iter('tr')]
+        if (len(rows) > 0) and all(h in rows[0] for h in headers):
+            return rows[0], [row for row in rows[1:] if len(row) == len(rows[0])]
+
+    return None, []
+
+
+# labels on the yahoo statistics page for each value
+YAHOO_STATS_FIELDS = {# valuation measures
+                      'ev_to_rev': 'Enterprise value/revenue',
+                      # profitability
+                      'operating_margin': 'Operating margin (ttm)',
+                      # management effectiveness
+                      'roa': 'Return on assets (ttm)',
+                      'roe': 'Return on equity (ttm)',
+                      # income statement
+                      'rev': 'Revenue (ttm)',
+                      'rev_per_share': 'Revenue per share (ttm)',
+                      'rev_growth_yoy': 'Quarterly revenue growth (yoy)',
+                      'ebitda': 'EBITDA',
+                      'eps_growth_yoy': 'Quarterly revenue growth (yoy)',
+                      # balance sheet
+                      'total_cash': 'Total cash (mrq)',
+                      'cash_per_share': 'Total cash per share (mrq)',
+                      'debt_to_equity': 'Total debt/equity (mrq)',
+                      'current_ratio': 'Current ratio (mrq)',
+                      'book_per_share': 'Book value per share (mrq)',
+                      # cash flow
+                      'operating_cash_flow_ttm': 'Operating cash flow (ttm)',
+                      'levered_fcf_ttm': 'Levered free cash flow (ttm)'
+                      }
+
 
 def extra_yahoo_data(ticker):
 
-    url = 'https://uk.finance.yahoo.com/quote/{}/key-statistics?p={}'.format(ticker, ticker)
-    headers = {"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:88.0) Gecko/20100101 Firefox/88.0"}
+    url = YAHOO_STATS_URL.format(ticker)
+    headers = YAHOO_HEADERS
 
     data = {}
 
     try:
         #table = pd.read_html(url) # Requires user agent headers
-        req = requests.get(url, headers=headers)
-        html = req.text
-        soup = BeautifulSoup(html, features="lxml")
-        table = soup.find('section', {"data-test": "qsp-statistics"})
+        req = http_get(url, headers=headers)
+        tree = html.fromstring(req.content)
+        table = tree.find('.//section[@data-test="qsp-statistics"]')
         stats_dict = yahoo_dict(table)
-        stats_df = pd.DataFrame.from_dict(stats_dict, orient='index')
+        stats_df = {0: {label: values[0] if len(values) > 0 else np.nan for label, values in stats_dict.items()}}
+    except FetchError:
+        raise
     except Exception as e:
-        data = {}
-        data['ev_to_rev'], data['operating_margin'] = '', ''
-        data['roa'], data['roe'] = '', ''
-        data['rev'], data['rev_per_share'], data['rev_growth_yoy'] = '', '', ''
-        data['ebitda'], data['eps_growth_yoy'] = '', ''
-        data['total_cash'], data['cash_per_share'], data['debt_to_equity'] = '', '', ''
-        data['current_ratio'], data['book_per_share'] = '', ''
-        data['operating_cash_flow_ttm'], data['levered_fcf_ttm'] = '', ''
+        data = {key: '' for key in YAHOO_STATS_FIELDS}
         print('error with extra yahoo data: ', ticker, e)
         return data
 
-    # valuation measures
     #print(stats_df)
-    data['ev_to_rev'] = check_nan(stats_df[0]['Enterprise value/revenue'])
-
-    # stock price history
-    # share statistics
-    # dividends and splits
-    # fiscal year
-
-    # profitability
-    data['operating_margin'] = check_nan(stats_df[0]['Operating margin (ttm)'])
-
-    # management effectiveness
-    data['roa'] = check_nan(stats_df[0]['Return on assets (ttm)'])
-    data['roe'] = check_nan(stats_df[0]['Return on equity (ttm)'])
-
-    # income statement
-    data['rev'] = check_nan(stats_df[0]['Revenue (ttm)'])
-    data['rev_per_share'] = check_nan(stats_df[0]['Revenue per share (ttm)'])
-    data['rev_growth_yoy'] = check_nan(stats_df[0]['Quarterly revenue growth (yoy)'])
-    data['ebitda'] = check_nan(stats_df[0]['EBITDA'])
-    data['eps_growth_yoy'] = check_nan(stats_df[0]['Quarterly revenue growth (yoy)'])
-
-    # balance sheet
-    data['total_cash'] = check_nan(stats_df[0]['Total cash (mrq)'])
-    data['cash_per_share'] = check_nan(stats_df[0]['Total cash per share (mrq)'])
-    data['debt_to_equity'] = check_nan(stats_df[0]['Total debt/equity (mrq)'])
-    data['current_ratio'] = check_nan(stats_df[0]['Current ratio (mrq)'])
-    data['book_per_share'] = check_nan(stats_df[0]['Book value per share (mrq)'])
-
-    # cash flow
-    data['operating_cash_flow_ttm'] = check_nan(stats_df[0]['Operating cash flow (ttm)'])
-    data['levered_fcf_ttm'] = check_nan(stats_df[0]['Levered free cash flow (ttm)'])
+    data = {key: check_nan(stats_df[0][label]) for key, label in YAHOO_STATS_FIELDS.items()}
 
     return data
 
 
 def yahoo_growth_analysis(ticker):
 
-    url = 'https://uk.finance.yahoo.com/quote/{}/analysis?p={}'.format(ticker, ticker)
-    headers = {"User-Agent": "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:88.0) Gecko/20100101 Firefox/88.0"}
+    url = YAHOO_ANALYSIS_URL.format(ticker)
+    headers = YAHOO_HEADERS
 
     data = {}
 
     # sales growth
     try:
         #table = pd.read_html(url)
-        req = requests.get(url, headers=headers)
-        html = req.text
-        soup = BeautifulSoup(html, features="lxml")
+        req = http_get(url, headers=headers)
+        tree = html.fromstring(req.content)
         # sales growth
-        table = soup.find('table', {"data-reactid": "86"})
+        table = tree.find('.//table[@data-reactid="86"]')
         sales_dict = yahoo_dict(table)
-        sales_df = pd.DataFrame.from_dict(sales_dict, orient='index', columns=['Current qtr', 'Next qtr',
-                                                                               'Current year', 'Next year'])
+        sales_df = yahoo_columns(sales_dict, ['Current qtr', 'Next qtr', 'Current year', 'Next year'])
         # eps history
-        table = soup.find('table', {"data-reactid": "178"})
+        table = tree.find('.//table[@data-reactid="178"]')
         eps_dict = yahoo_dict(table)
         # growth estimates
-        table = soup.find('table', {"data-reactid": "387"})
+        table = tree.find('.//table[@data-reactid="387"]')
         growth_dict = yahoo_dict(table)
-        growth_df = pd.DataFrame.from_dict(growth_dict, orient='index',
-                                           columns=[ticker, 'Industry', 'Sector', 'S&P 500'])
+        growth_df = yahoo_columns(growth_dict, [ticker, 'Industry', 'Sector', 'S&P 500'])
         #growth_df = pd.DataFrame.from_dict(growth_dict, orient='index',
         #                                   columns=[ticker])
+    except FetchError:
+        raise
     except Exception as e:
         data['curr_q_sales_growth'], data['next_q_sales_growth'] = '', ''
         data['curr_year_sales_growth'], data['next_year_sales_growth'] = '', ''
@@ -277,7 +1192,7 @@ def yahoo_growth_analysis(ticker):
     data['sales_accel_y'] = sales_accel_y
 
     # earnings history
-    eps_df = pd.DataFrame.from_dict(eps_dict, orient='index', columns=['q-4', 'q-3', 'q-2', 'q-1'])
+    eps_df = yahoo_columns(eps_dict, ['q-4', 'q-3', 'q-2', 'q-1'])
 
     four, three, two, one = check_nan(eps_df['q-4']['Surprise %']), check_nan(eps_df['q-3']['Surprise %']), \
                             check_nan(eps_df['q-2']['Surprise %']), check_nan(eps_df['q-1']['Surprise %'])
@@ -328,7 +1243,7 @@ def scrape_whalewisdom(ticker):
     # make url
     url = 'https://whalewisdom.com/stock/{}'.format(ticker)
 
-    page = requests.get(url, stream=True)
+    page = http_get(url)
 
     tree = html.fromstring(page.content)
 
@@ -367,40 +1282,35 @@ def scrape_whalewisdom(ticker):
 
 def scrape_openinsider(ticker):
 
-    # 1Y insiders
-    url = 'http://www.openinsider.com/screener?s={}&o=&pl=&ph=&ll=&lh=&fd=365&fdr=&td=0&tdr=&fdlyl=&fdlyh=&' \
-          'daysago=&xp=1&vl=&vh=&ocl=&och=&sic1=-1&sicl=100&sich=9999&grp=0&nfl=&nfh=&nil=&nih=&nol=&noh=&v2l=&v2h=&' \
-          'oc2l=&oc2h=&sortcol=0&cnt=100&page=1'.format(ticker)
+    # 1Y insiders, 6M is worked out from the filing dates rather than fetching the page again
+    url = OPENINSIDER_URL.format(ticker)
 
     try:
-        table = pd.read_html(url)[11]['Value']
-        num_buys = len(table.values)
-        values = [int(x.strip('+$').replace(',', '')) for x in table.values]
-        total_value = np.sum(values)
-
-        data = {'1Y_buys': num_buys,
-                '1Y_totalval': str(total_value)
-        }
+        header, rows = find_table(html.fromstring(http_get(url).content), ['Filing Date', 'Value'])
+        if header is None:
+            raise KeyError('Value')
+        value_col, filed_col = header.index('Value'), header.index('Filing Date')
+        values = np.array([int(row[value_col].strip('+$').replace(',', '')) for row in rows], dtype=np.int64)
+        filed = pd.to_datetime([row[filed_col] for row in rows]).values
     except KeyError as e:
         data = {'1Y_buys': '',
-                '1Y_totalval': ''
+                '1Y_totalval': '',
+                '6M_buys': '',
+                '6M_totalval': ''
                 }
         print('error with openinsider: ', ticker, e)
+        return data
 
-    # 6M insiders
-    url = 'http://www.openinsider.com/screener?s={}&o=&pl=&ph=&ll=&lh=&fd=180&fdr=&td=0&tdr=&fdlyl=&fdlyh=&' \
-          'daysago=&xp=1&vl=&vh=&ocl=&och=&sic1=-1&sicl=100&sich=9999&grp=0&nfl=&nfh=&nil=&nih=&nol=&noh=&v2l=&' \
-          'v2h=&oc2l=&oc2h=&sortcol=0&cnt=100&page=1'.format(ticker)
-
-    try:
-        table = pd.read_html(url)[11]['Value']
-        num_buys = len(table.values)
-        values = [int(x.strip('+$').replace(',', '')) for x in table.values]
-        total_value = np.sum(values)
+    data = {'1Y_buys': len(values),
+            '1Y_totalval': str(np.sum(values))
+    }
 
-        data['6M_buys'] = num_buys
-        data['6M_totalval'] = str(total_value)
-    except KeyError as e:
+    # 6M insiders
+    recent = filed >= np.datetime64(dt.datetime.now() - dt.timedelta(days=180))
+    if np.any(recent):
+        data['6M_buys'] = int(np.count_nonzero(recent))
+        data['6M_totalval'] = str(np.sum(values[recent]))
+    else:
         data['6M_buys'] = ''
         data['6M_totalval'] = ''
 
@@ -412,16 +1322,32 @@ def scrape_earnings(ticker):
     url = 'https://stocksearning.com/stocks/{}/earnings-date'.format(ticker)
 
     try:
-        page = requests.get(url, stream=True)
+        page = http_get(url)
         tree = html.fromstring(page.content)
 
         earndate = tree.xpath('//*[@id="ContentPlaceHolder1_lblEarningDate"]/text()')[0]
+    except FetchError:
+        raise
     except Exception as e:
         earndate = ''
         print('error with earnings date: ', ticker, e)
     return earndate
 
 
+def load_ciks(fields):
+    # only read when the cik column is being updated, most narrow runs don't need pandas otherwise
+    if 'cik' not in [field.name for field in fields]:
+        return None
+    try:
+        ciks = pd.read_csv('ticker_cik.csv', index_col=0)
+        print('Loaded CIKS')
+    except:
+        ciks = None
+        print('Error loading CIKS')
+
+    return ciks
+
+
 def get_cik(ciks, ticker):
 
     return ciks.loc[(ticker).lower()][0]
@@ -446,7 +1372,10 @@ def scrape_finviz(ticker):
     # 'Volume': '5,792,861', 'Change': '-5.20%'}
 
     try:
-        stock = finvizfinance(ticker)
+        rate_limit('finviz')
+        stock = guarded('finviz', finviz_quote.finvizfinance, ticker)
+    except FetchError:
+        raise
     except Exception as e:
         return {}
 
@@ -454,9 +1383,48 @@ def scrape_finviz(ticker):
     return stock.ticker_fundament()
 
 
+def bulk_finviz_data(tickers, chunksize=20):
+    # finviz values for the whole watchlist from the screener, a page for every 20 tickers instead of a quote
+    # page each. Tickers the screener doesn't give back are scraped on their own
+    cols = ','.join(str(c) for c in FINVIZ_SCREENER_COLUMNS.values())
+    data = {}
+    for n in range(0, len(tickers), chunksize):
+        chunk = tickers[n:n + chunksize]
+        try:
+            page = http_get(FINVIZ_SCREENER_URL.format(','.join(chunk), cols), headers=YAHOO_HEADERS)
+            header, rows = find_table(html.fromstring(page.content), ['Ticker', 'EPS Q/Q'])
+        except Exception as e:
+            # an empty or error page too, these tickers get their quote pages instead
+            print('error getting finviz screener: ', e)
+            continue
+        if header is None:
+            print('No finviz screener table for', ', '.join(chunk))
+            continue
+
+        keys = [FINVIZ_SCREENER_HEADERS.get(h, h) for h in header]
+        for row in rows:
+            values = dict(zip(keys, row))
+            data[values.pop('Ticker')] = values
+
+    return data
+
+
+# finviz values from the screener at the start of the run
+bulk_finviz = {}
+
+
+def lookup_finviz(ticker):
+
+    if ticker in bulk_finviz:
+        return dict(bulk_finviz[ticker])
+
+    return scrape_finviz(ticker)
+
+
 def get_up_down_vol(ticker):
 
-    price_data = yf.download(ticker, start=dt.datetime.today()-dt.timedelta(days=90))
+    rate_limit('yahoo')
+    price_data = guarded('yahoo', yf.download, ticker, start=dt.datetime.today()-dt.timedelta(days=90))
 
     close = price_data['Adj Close']
     open = price_data['Open']
@@ -476,8 +1444,1066 @@ def get_up_down_vol(ticker):
     return updown_vol
 
 
-def main():
+def up_down_vol_ratios(close, open, vol):
+    # same as get_up_down_vol for every column (ticker) of the price frames at once
+    price_diff = (close - open).iloc[-65:].values
+    avg_vol = vol.iloc[-65:].rolling(window=30).mean().values
+    vol = vol.iloc[-65:].values
+
+    # count_nonzero counts nan volumes too, so only zero volumes are dropped
+    traded = vol != 0
+    with np.errstate(invalid='ignore'):
+        high_vol = vol >= avg_vol
+        up = (price_diff > 0) & traded
+        down = (price_diff < 0) & traded
+
+    upvol_count = np.count_nonzero(up & high_vol, axis=0)
+    downvol_count = np.count_nonzero(down & high_vol, axis=0)
+    # no high volume down days, fall back to all days
+    upvol_all = np.count_nonzero(up, axis=0)
+    downvol_all = np.count_nonzero(down, axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        updown_vol = np.where(downvol_count > 0, upvol_count / downvol_count,
+                              np.where(downvol_all > 0, upvol_all / downvol_all, np.nan))
+
+    return dict(zip(close.columns, updown_vol))
+
+
+def bulk_up_down_vol(tickers, chunksize=100):
+    # download prices for the whole watchlist in a few calls and work out up/down volume for them all
+    ratios = {}
+    for n in range(0, len(tickers), chunksize):
+        chunk = tickers[n:n + chunksize]
+        rate_limit('yahoo')
+        try:
+            price_data = yf.download(chunk, start=dt.datetime.today()-dt.timedelta(days=90), group_by='column')
+        except Exception as e:
+            print('error downloading prices: ', e)
+            continue
+        if not isinstance(price_data.columns, pd.MultiIndex):
+            price_data.columns = pd.MultiIndex.from_product([price_data.columns, chunk])
+
+        close = price_data['Adj Close']
+        open = price_data['Open']
+        vol = price_data['Volume']
+
+        # tickers with gaps in the shared date index are done on their own rows only
+        complete = [t for t in close.columns if not close[t].isna().any()]
+        ratios.update(up_down_vol_ratios(close[complete], open[complete], vol[complete]))
+        for t in close.columns:
+            if t in complete:
+                continue
+            rows = close[t].notna()
+            if not rows.any():
+                continue
+            ratios.update(up_down_vol_ratios(close.loc[rows, [t]], open.loc[rows, [t]], vol.loc[rows, [t]]))
+
+    return ratios
+
+
+# up/down volume worked out in bulk at the start of the run
+bulk_updown = {}
+
+
+def lookup_up_down_vol(ticker):
+
+    if ticker in bulk_updown:
+        return bulk_updown[ticker]
+
+    return get_up_down_vol(ticker)
 
+
+# compact the journal once it gets bigger than this
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+
+
+class Journal:
+    # append only record of the tickers each run scraped and wrote, read back to find new tickers and to resume
+
+    def __init__(self, path, legacy='prior_tickers.csv'):
+        self.path = path
+        # tickers written by any run
+        self.known = set()
+        # latest run, as (run id, args, {ticker: api_calls} scraped, written tickers, finished)
+        self.last = None
+        self.run = None
+
+        # tickers from before the journal, index,ticker rows. Read with csv so runs don't have to import pandas
+        if os.path.exists(legacy):
+            try:
+                with open(legacy, 'r', newline='') as file:
+                    self.known.update(row[1] for row in csv.reader(file) if len(row) > 1)
+                print('Loaded csv of tickers')
+            except Exception as e:
+                pass
+
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                for line in file:
+                    try:
+                        self.read_entry(json.loads(line))
+                    except ValueError:
+                        # half written line from a run that was killed
+                        continue
+        self.file = open(path, 'a')
+        self.end_line()
+
+    def end_line(self):
+        # finish off a half written last line, or the next entry would be glued onto it and lost
+        if self.file.tell() == 0:
+            return
+        with open(self.path, 'rb') as file:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b'\n':
+                self.file.write('\n')
+                self.file.flush()
+
+    def read_entry(self, entry):
+        event = entry['event']
+        if event in ('known', 'written'):
+            # written by any run, not just the latest
+            self.known.update(entry['tickers'])
+        if event == 'start':
+            self.last = (entry['run'], entry['args'], {}, set(), False)
+        elif (event == 'known') or (self.last is None) or (entry['run'] != self.last[0]):
+            return
+        elif event == 'scraped':
+            self.last[2][entry['ticker']] = [tuple(call) for call in entry['calls']]
+        elif event == 'written':
+            self.last[3].update(entry['tickers'])
+        elif event == 'finished':
+            self.last = self.last[:4] + (True,)
+
+    def add(self, entry):
+        self.file.write(json.dumps(entry, default=str) + '\n')
+        self.file.flush()
+
+    def unfinished(self):
+        # the last run if it didn't get to the end
+        if (self.last is None) or self.last[4]:
+            return None
+        return self.last
+
+    def start(self, argv, run=None):
+        if run is None:
+            self.run = dt.datetime.now().isoformat()
+            self.add({'event': 'start', 'run': self.run, 'args': argv})
+        else:
+            self.run = run
+            self.add({'event': 'resumed', 'run': run})
+
+    def scraped(self, ticker, api_calls):
+        self.add({'event': 'scraped', 'run': self.run, 'ticker': ticker,
+                  'calls': [[cell, clean_value(val)] for cell, val in api_calls]})
+
+    def written(self, tickers):
+        self.known.update(tickers)
+        self.add({'event': 'written', 'run': self.run, 'tickers': tickers})
+
+    def finish(self):
+        self.add({'event': 'finished', 'run': self.run})
+        if os.path.getsize(self.path) > JOURNAL_COMPACT_BYTES:
+            self.compact()
+
+    def compact(self):
+        # finished runs only matter for the tickers they wrote
+        self.file.close()
+        with open(self.path + '.tmp', 'w') as file:
+            file.write(json.dumps({'event': 'known', 'tickers': sorted(self.known)}) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+        self.file = open(self.path, 'a')
+        print('Compacted journal', self.path)
+
+    def close(self):
+        self.file.close()
+
+
+def scrape_whales(ticker):
+
+    whales = scrape_whalewisdom(ticker)
+    nd = len(whales)
+    emp = 0
+    for k, v in whales.items():
+        if v == '':
+            emp += 1
+    if emp == nd:
+        whales = scrape_whalewisdom(ticker+'-2')
+
+    return whales
+
+
+# data sources: name -> (function, host)
+SOURCES = {'yahoo': (yahoo_data, 'yahoo'),
+           'yahoo_stats': (extra_yahoo_data, 'yahoo'),
+           'yahoo_growth': (yahoo_growth_analysis, 'yahoo'),
+           'finviz': (lookup_finviz, 'finviz'),
+           'whales': (scrape_whales, 'whalewisdom'),
+           'insiders': (scrape_openinsider, 'openinsider'),
+           'updown': (lookup_up_down_vol, 'yahoo'),
+           'earnings': (scrape_earnings, 'stocksearning')
+           }
+# what each source gives back when its host couldn't be reached, every field blank
+SOURCE_BLANKS = {'yahoo': lambda: ({}, ''),
+                 'yahoo_stats': lambda: defaultdict(str),
+                 'yahoo_growth': lambda: defaultdict(str),
+                 'finviz': lambda: {},
+                 'whales': lambda: defaultdict(str),
+                 'insiders': lambda: defaultdict(str),
+                 'updown': lambda: '',
+                 'earnings': lambda: ''
+                 }
+# tickers with sources that failed, fetched again at the end of the run: ticker -> (row, results that worked)
+retry_later = {}
+retry_lock = threading.Lock()
+
+
+def take_retries():
+
+    with retry_lock:
+        retries = dict(retry_later)
+        retry_later.clear()
+
+    return retries
+
+
+def set_host_limits(limits):
+
+    HOST_LIMITS.update(limits)
+    for host, limit in HOST_LIMITS.items():
+        host_semaphores[host] = threading.BoundedSemaphore(limit)
+
+
+def run_source(name, ticker):
+    # run a single data source, holding a slot for its host while it runs
+    func, host = SOURCES[name]
+    if host not in host_semaphores:
+        host_semaphores[host] = threading.BoundedSemaphore(HOST_LIMITS.get(host, 1))
+
+    with timed('hostslot', host):
+        host_semaphores[host].acquire()
+    try:
+        with timed('scrape', name):
+            return func(ticker)
+    finally:
+        host_semaphores[host].release()
+
+
+def content_hash(val):
+
+    return hashlib.sha1(json.dumps(val, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def source_failed(result):
+    # nothing worth keeping came back from the source
+    if isinstance(result, (tuple, list)):
+        result = result[0]
+    if isinstance(result, dict):
+        return all(v == '' for v in result.values())
+    return result == ''
+
+
+class StateStore:
+    # last fetched data for each ticker and source, and last written value for each cell
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sources (ticker TEXT, source TEXT, data TEXT, hash TEXT, '
+                        'fetched REAL, PRIMARY KEY (ticker, source))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS cells (ticker TEXT, col TEXT, row INTEGER, hash TEXT, '
+                        'written REAL, PRIMARY KEY (ticker, col))')
+        self.db.commit()
+
+    def get_source(self, ticker, source, max_age):
+        # stored data if it was fetched recently enough
+        with self.lock:
+            row = self.db.execute('SELECT data, fetched FROM sources WHERE ticker = ? AND source = ?',
+                                  (ticker, source)).fetchone()
+        if (row is None) or (dt.datetime.now().timestamp() - row[1] >= max_age):
+            return None
+        return json.loads(row[0])
+
+    def put_source(self, ticker, source, data):
+        # returns False if the data is the same as last time
+        new_hash = content_hash(data)
+        with self.lock:
+            row = self.db.execute('SELECT hash FROM sources WHERE ticker = ? AND source = ?',
+                                  (ticker, source)).fetchone()
+            self.db.execute('REPLACE INTO sources VALUES (?, ?, ?, ?, ?)',
+                            (ticker, source, json.dumps(data, default=str), new_hash,
+                             dt.datetime.now().timestamp()))
+            self.db.commit()
+        return (row is None) or (row[0] != new_hash)
+
+    def changed_calls(self, ticker, api_calls):
+        # only the cells that differ from what was last written for this ticker
+        with self.lock:
+            written = dict(((col, (row, h)) for col, row, h in
+                            self.db.execute('SELECT col, row, hash FROM cells WHERE ticker = ?', (ticker,))))
+        changed = []
+        for row, col, field, val in calls_by_field(api_calls):
+            if written.get(col) != (row, content_hash(clean_value(val))):
+                changed.append((row, col, field, val))
+        return narrow_calls(api_calls, changed)
+
+    def put_calls(self, ticker, api_calls):
+        now = dt.datetime.now().timestamp()
+        rows = []
+        for row, col, field, val in calls_by_field(api_calls):
+            rows.append((ticker, col, row, content_hash(clean_value(val)), now))
+        with self.lock:
+            self.db.executemany('REPLACE INTO cells VALUES (?, ?, ?, ?, ?)', rows)
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def fetch_sources(pool, ticker, names, known=None):
+    # fetch all the sources for a ticker at once, so the slowest source sets the time taken
+    # returns the results and the names of sources that couldn't be fetched
+    results = {}
+    futures = {}
+    failed = []
+    for name in names:
+        if (known is not None) and (name in known):
+            results[name] = known[name]
+            continue
+        # incremental runs reuse anything fetched recently
+        if state_store is not None:
+            stored = state_store.get_source(ticker, name, SOURCE_REFRESH.get(name, 0))
+            if stored is not None:
+                results[name] = stored
+                continue
+        futures[name] = pool.submit(run_source, name, ticker)
+
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            # network errors or a page that couldn't be parsed, only this source is blanked
+            print('Could not get', name, 'for', ticker, e)
+            results[name] = SOURCE_BLANKS[name]()
+            failed.append(name)
+            continue
+        if (state_store is not None) and (not source_failed(results[name])):
+            if not state_store.put_source(ticker, name, results[name]):
+                print('No change in', name, 'for', ticker)
+
+    return results, failed
+
+
+class Field:
+    # a sheet column and where its value comes from. chain is (source, extract, normalise) steps tried in turn
+    # until one gives a value that isn't blank. extract gets the source's result, or the ticker and ciks when
+    # the source is None, and normalise names the normaliser the value goes through
+
+    def __init__(self, name, col, group, *chain):
+        self.name = name
+        self.col = col
+        self.group = group
+        self.chain = chain
+
+    def sources(self):
+        return [source for source, extract, normalise in self.chain if source is not None]
+
+
+NORMALISERS = {'round': check_round,
+               'nan': check_nan,
+               'round_nan': lambda value: check_nan(check_round(value))
+               }
+
+
+def info_item(key):
+    # from the yfinance info, blank when yahoo couldn't be reached
+    return lambda result: result[0][key] if len(result[0]) > 0 else ''
+
+
+def info_millions(key, suffix=''):
+
+    def extract(result):
+        if len(result[0]) == 0:
+            return ''
+        try:
+            return str(check_round(result[0][key]/1e6)) + suffix
+        except TypeError:
+            return ''
+
+    return extract
+
+
+def result_item(key):
+
+    return lambda result: result[key]
+
+
+def finviz_item(key):
+    # finviz gives back an empty dict when the page couldn't be read
+    return lambda result: result[key] if len(result) > 0 else ''
+
+
+def cik_value(ticker, ciks):
+
+    try:
+        return str(get_cik(ciks, ticker))
+    except:
+        return ''
+
+
+def whale_change(key, prior_key):
+
+    def extract(whales):
+        if (whales[key] == '') or (whales[prior_key] == ''):
+            return ''
+        return str(int(whales[key]) - int(whales[prior_key]))
+
+    return extract
+
+
+def whales_own(whales):
+
+    own = str(check_round(whales['own']))+'%'
+    if own == '%':
+        return ''
+    return own
+
+
+# every field in the sheet, in the order the updates are sent. Finviz only fills in for empty yahoo data
+# on some fields, and yahoo for empty finviz data on others
+FIELDS = [Field('name', 'E', 'basic', ('yahoo', info_item('shortName'), None)),
+          Field('biz', 'F', 'basic', ('yahoo', info_item('longBusinessSummary'), None)),
+          Field('cik', 'G', 'basic', (None, cik_value, None)),
+          Field('sector', 'H', 'basic', ('yahoo', info_item('sector'), None)),
+          Field('industry', 'I', 'basic', ('yahoo', info_item('industry'), None)),
+          Field('earndate', 'J', 'basic', ('earnings', lambda result: result, None)),
+          Field('float', 'M', 'basic', ('yahoo', info_millions('floatShares'), None)),
+          Field('updown_vol', 'V', 'basic', ('updown', lambda result: result, 'round_nan')),
+
+          Field('eps_qoq', 'X', 'eps', ('finviz', finviz_item('EPS Q/Q'), 'nan')),
+          Field('eps_beats', 'Y', 'eps', ('yahoo_growth', result_item('eps_beats'), None)),
+          Field('earnings_curr_q', 'Z', 'eps', ('yahoo_growth', result_item('earnings_curr_q'), None)),
+          Field('earnings_next_q', 'AA', 'eps', ('yahoo_growth', result_item('earnings_next_q'), None)),
+          Field('eps_accel', 'AB', 'eps', ('yahoo_growth', result_item('eps_accel'), None)),
+          Field('eps_last_five_years', 'AD', 'eps', ('finviz', finviz_item('EPS past 5Y'), 'nan'),
+                ('yahoo_growth', result_item('earnings_past_5y'), None)),
+          Field('earnings_curr_year', 'AE', 'eps', ('yahoo_growth', result_item('earnings_curr_year'), None),
+                ('finviz', finviz_item('EPS this Y'), 'nan')),
+          Field('earnings_next_year', 'AF', 'eps', ('yahoo_growth', result_item('earnings_next_year'), None),
+                ('finviz', finviz_item('EPS next Y'), 'nan')),
+          Field('eps_accel_y', 'AG', 'eps', ('yahoo_growth', result_item('eps_accel_y'), None)),
+          Field('eps_next_five_years', 'AI', 'eps', ('finviz', finviz_item('EPS next 5Y'), 'nan'),
+                ('yahoo_growth', result_item('earnings_next_5y'), None)),
+
+          Field('rev_qoq', 'AJ', 'rev', ('finviz', finviz_item('Sales Q/Q'), 'nan')),
+          Field('curr_q_sales_growth', 'AK', 'rev', ('yahoo_growth', result_item('curr_q_sales_growth'), None)),
+          Field('next_q_sales_growth', 'AL', 'rev', ('yahoo_growth', result_item('next_q_sales_growth'), None)),
+          Field('sales_accel', 'AM', 'rev', ('yahoo_growth', result_item('sales_accel'), None)),
+          Field('sales_last_five_years', 'AO', 'rev', ('finviz', finviz_item('Sales past 5Y'), 'nan')),
+          Field('curr_year_sales_growth', 'AP', 'rev', ('yahoo_growth', result_item('curr_year_sales_growth'), None)),
+          Field('next_year_sales_growth', 'AQ', 'rev', ('yahoo_growth', result_item('next_year_sales_growth'), None)),
+          Field('gross_margin', 'AT', 'rev', ('finviz', finviz_item('Gross Margin'), 'nan')),
+          Field('sales_accel_y', 'AR', 'rev', ('yahoo_growth', result_item('sales_accel_y'), None)),
+
+          Field('profit_margins', 'AU', 'fundamental', ('yahoo', info_item('profitMargins'), 'round')),
+          Field('operating_margin', 'AV', 'fundamental', ('yahoo_stats', result_item('operating_margin'), None)),
+          Field('rev', 'AW', 'fundamental', ('yahoo_stats', result_item('rev'), None)),
+          Field('ev_to_rev', 'AY', 'fundamental', ('yahoo_stats', result_item('ev_to_rev'), None)),
+          Field('rev_per_share', 'AZ', 'fundamental', ('yahoo_stats', result_item('rev_per_share'), None)),
+          Field('price_to_sales_ttm', 'BA', 'fundamental',
+                ('yahoo', info_item('priceToSalesTrailing12Months'), 'round')),
+          Field('price_to_book', 'BB', 'fundamental', ('yahoo', info_item('priceToBook'), 'round')),
+          Field('peg', 'BC', 'fundamental', ('yahoo', info_item('pegRatio'), 'round')),
+          Field('forward_pe', 'BF', 'fundamental', ('yahoo', info_item('forwardPE'), 'round')),
+          Field('ev', 'BG', 'fundamental', ('yahoo', info_millions('enterpriseValue', 'M'), None)),
+          Field('ev_to_ebitda', 'BI', 'fundamental', ('yahoo', info_item('enterpriseToEbitda'), 'round')),
+          Field('ebitda', 'BJ', 'fundamental', ('yahoo_stats', result_item('ebitda'), None)),
+          Field('beta', 'BL', 'fundamental', ('yahoo', info_item('beta'), 'round')),
+          Field('book_per_share', 'BM', 'fundamental', ('yahoo_stats', result_item('book_per_share'), None)),
+          Field('roa', 'BN', 'fundamental', ('yahoo_stats', result_item('roa'), None),
+                ('finviz', finviz_item('ROA'), 'nan')),
+          Field('roe', 'BO', 'fundamental', ('yahoo_stats', result_item('roe'), None),
+                ('finviz', finviz_item('ROE'), 'nan')),
+          Field('total_cash', 'BP', 'fundamental', ('yahoo_stats', result_item('total_cash'), None)),
+          Field('cash_per_share', 'BQ', 'fundamental', ('yahoo_stats', result_item('cash_per_share'), None)),
+          Field('debt_to_equity', 'BR', 'fundamental', ('yahoo_stats', result_item('debt_to_equity'), None)),
+          Field('current_ratio', 'BS', 'fundamental', ('yahoo_stats', result_item('current_ratio'), None)),
+          Field('operating_cash_flow_ttm', 'BT', 'fundamental',
+                ('yahoo_stats', result_item('operating_cash_flow_ttm'), None)),
+          Field('levered_fcf_ttm', 'BU', 'fundamental', ('yahoo_stats', result_item('levered_fcf_ttm'), None)),
+
+          Field('insider_year_buys', 'BX', 'insider', ('insiders', result_item('1Y_buys'), None)),
+          Field('insider_year_totalval', 'BY', 'insider', ('insiders', result_item('1Y_totalval'), None)),
+          Field('insider_6mon_buys', 'BZ', 'insider', ('insiders', result_item('6M_buys'), None)),
+          Field('insider_6mon_totalval', 'CA', 'insider', ('insiders', result_item('6M_totalval'), None)),
+          Field('insider_own', 'CB', 'insider', ('yahoo', info_item('heldPercentInsiders'), 'round')),
+
+          Field('whale_holders', 'CC', 'whale', ('whales', result_item('holders'), None)),
+          Field('whale_holders_q_change', 'CD', 'whale', ('whales', whale_change('holders', 'priorq_holders'), None)),
+          Field('whale_new_positions', 'CE', 'whale', ('whales', result_item('new_positions'), None)),
+          Field('whale_new_positions_q_change', 'CF', 'whale',
+                ('whales', whale_change('new_positions', 'new_positions_lastq'), None)),
+          Field('whale_shares', 'CG', 'whale', ('whales', result_item('shares'), None)),
+          # whale_shares - whale_shares_lastq
+          Field('whale_shares_q_change', 'CH', 'whale', (None, lambda ticker, ciks: '', None)),
+          Field('whales_own', 'CI', 'whale', ('whales', whales_own, None)),
+          Field('topholders', 'CJ', 'whale', ('yahoo', lambda result: result[1], None))
+          ]
+FIELD_GROUPS = ['basic', 'eps', 'rev', 'fundamental', 'insider', 'whale']
+FIELD_NAMES = [field.name for field in FIELDS]
+
+COLUMN_FIELDS = dict([('C', 'status')] + [(field.col, field.name) for field in FIELDS])
+FIELD_COLUMNS = {field: col for col, field in COLUMN_FIELDS.items()}
+
+
+def field_list(value):
+    # names given to --fields
+    if value is None:
+        return []
+    return [name.strip() for name in value.split(',') if name.strip() != '']
+
+
+def select_fields(groups, names=()):
+    # fields in the selected groups plus any picked by name, in sheet order
+    return [field for field in FIELDS if (field.group in groups) or (field.name in names)]
+
+
+def field_columns(fields):
+    # sheet columns updated for the selected fields
+    return ['C'] + [field.col for field in fields]
+
+
+def field_sources(fields):
+    # sources fetched up front, fallbacks are only fetched when they're needed
+    names = []
+    for field in fields:
+        source = field.chain[0][0]
+        if (source is not None) and (source not in names):
+            names.append(source)
+    return names
+
+
+def is_blank(val):
+
+    return isinstance(val, str) and (val == '')
+
+
+def fill_record(record, fields, results, ciks):
+    # set each field from the first step in its chain that isn't blank, skipping steps for sources that weren't
+    # fetched, and blank if none of them were
+    todo = list(fields)
+    step = 0
+    while len(todo) > 0:
+        for field in todo:
+            source, extract, normalise = field.chain[step]
+            if source is None:
+                val = extract(record.ticker, ciks)
+            elif source in results:
+                val = extract(results[source])
+            else:
+                continue
+            if normalise is not None:
+                val = NORMALISERS[normalise](val)
+            setattr(record, field.name, val)
+
+        step += 1
+        todo = [field for field in todo if (len(field.chain) > step) and is_blank(getattr(record, field.name, ''))]
+
+    for field in fields:
+        if not hasattr(record, field.name):
+            setattr(record, field.name, '')
+
+    return record
+
+
+# status then every field, the layout of a TickerRecord
+RECORD_FIELDS = ['status'] + FIELD_NAMES
+
+
+class TickerRecord:
+    # one ticker's values with a slot for each field, filled in place as the fields are extracted. Slots that
+    # aren't set aren't written. Iterating gives the (cell, value) updates used by the journal
+    # and work queue, only made when they're asked for
+    __slots__ = ['ticker', 'row'] + RECORD_FIELDS
+
+    def __init__(self, ticker, row):
+        self.ticker = ticker
+        self.row = row
+
+    def items(self):
+        # (field, value) for each slot that's set, in sheet order
+        for name in RECORD_FIELDS:
+            val = getattr(self, name, self)
+            if val is not self:
+                yield name, val
+
+    def __iter__(self):
+        row = str(self.row)
+        for name, val in self.items():
+            yield FIELD_COLUMNS[name] + row, val
+
+    def __len__(self):
+        return sum(1 for item in self.items())
+
+    def keep(self, names):
+        # clear the slots not in names
+        names = set(names)
+        for name, val in list(self.items()):
+            if name not in names:
+                delattr(self, name)
+        return self
+
+
+def records_to_frame(records):
+    # a row per record and a column per field, built a column at a time
+    records = list(records)
+    data = {'row': [record.row for record in records],
+            'ticker': [record.ticker for record in records]}
+    for name in RECORD_FIELDS:
+        data[name] = [getattr(record, name, '') for record in records]
+
+    return pd.DataFrame(data, columns=['row', 'ticker'] + RECORD_FIELDS)
+
+
+class HistoryStore:
+    # append only record of every scraped value, one row per ticker, field and run
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, started REAL, args TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS snapshots (run_id TEXT, scraped REAL, ticker TEXT, '
+                        'row INTEGER, field TEXT, col TEXT, value TEXT)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS snapshots_ticker ON snapshots (ticker, field, scraped)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS snapshots_run ON snapshots (run_id)')
+        self.db.commit()
+        self.run_id = None
+
+    def start_run(self, args):
+        started = dt.datetime.now()
+        self.run_id = started.strftime('%Y%m%d%H%M%S%f')
+        with self.lock:
+            self.db.execute('INSERT INTO runs VALUES (?, ?, ?)', (self.run_id, started.timestamp(), ' '.join(args)))
+            self.db.commit()
+
+    def add(self, ticker, api_calls):
+        now = dt.datetime.now().timestamp()
+        rows = []
+        for row, col, field, val in calls_by_field(api_calls):
+            rows.append((self.run_id, now, ticker, row, field, col, json.dumps(clean_value(val))))
+        with self.lock:
+            self.db.executemany('INSERT INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.commit()
+
+    def latest(self, ticker):
+        # most recent value of every field for a ticker
+        with self.lock:
+            rows = self.db.execute('SELECT run_id, field, value FROM snapshots WHERE ticker = ? ORDER BY scraped',
+                                   (ticker,)).fetchall()
+        values = {}
+        for run_id, field, val in rows:
+            values[field] = json.loads(val)
+        # the error flag only counts if the last scrape failed
+        if (len(rows) > 0) and ('status' in values):
+            if not any((run_id == rows[-1][0]) and (field == 'status') for run_id, field, val in rows):
+                del values['status']
+        return values
+
+    def rebuild_calls(self, ticker, row, cols):
+        # sheet updates for a ticker from its stored values, without scraping anything
+        calls = []
+        for field, val in self.latest(ticker).items():
+            col = FIELD_COLUMNS.get(field)
+            if (col is not None) and (col in cols):
+                calls.append((col + str(row), val))
+        return calls
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class GSheetSink:
+    # google sheet, every batch of updates goes in one batch_update call
+
+    def __init__(self, maintable, snapshot):
+        self.maintable = maintable
+        self.cells = snapshot
+
+    def snapshot(self):
+        return self.cells
+
+    def write(self, updates):
+        grid = {}
+        for ticker, api_calls in updates:
+            calls_to_grid(api_calls, grid)
+        push_updates(self.maintable, grid=grid)
+
+    def close(self):
+        pass
+
+
+class TableSink:
+    # local table with a row per ticker and a column per field, saved when the run ends
+
+    def __init__(self, path):
+        self.path = path
+        # a TickerRecord for each row
+        self.rows = {}
+        if os.path.exists(path):
+            for saved in self.load().to_dict('records'):
+                record = TickerRecord(saved.get('ticker', ''), int(saved['row']))
+                for name in RECORD_FIELDS:
+                    val = saved.get(name)
+                    if (val is not None) and (str(val) != ''):
+                        setattr(record, name, val)
+                self.rows[record.row] = record
+
+    def snapshot(self):
+        cells = {}
+        for row, record in self.rows.items():
+            for field, val in record.items():
+                if (val is not None) and (str(val) != ''):
+                    cells[(row, col_to_num(FIELD_COLUMNS[field]))] = str(val)
+        return cells
+
+    def write(self, updates):
+        for ticker, api_calls in updates:
+            for row, col, field, val in calls_by_field(api_calls):
+                if row not in self.rows:
+                    self.rows[row] = TickerRecord(ticker, row)
+                record = self.rows[row]
+                record.ticker = ticker
+                setattr(record, field, clean_value(val))
+
+    def frame(self):
+        return records_to_frame(self.rows[row] for row in sorted(self.rows))
+
+    def close(self):
+        self.save()
+        print('Saved', len(self.rows), 'rows to', self.path)
+
+
+class CSVSink(TableSink):
+
+    def load(self):
+        return pd.read_csv(self.path, dtype=str, keep_default_na=False)
+
+    def save(self):
+        self.frame().to_csv(self.path, index=False)
+
+
+class ParquetSink(TableSink):
+    # needs pyarrow or fastparquet installed
+
+    def load(self):
+        return pd.read_parquet(self.path)
+
+    def save(self):
+        frame = self.frame()
+        # columns mix numbers and text, so keep them as the text the sheet would show
+        for col in frame.columns:
+            if col != 'row':
+                frame[col] = frame[col].astype(str)
+        frame.to_parquet(self.path, index=False)
+
+
+class SQLiteSink:
+    # local sqlite table with a row per ticker and field, written as each batch arrives
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS cells (row INTEGER, ticker TEXT, field TEXT, col TEXT, '
+                        'value TEXT, PRIMARY KEY (row, field))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS cells_ticker ON cells (ticker)')
+        self.db.commit()
+
+    def snapshot(self):
+        cells = {}
+        for row, col, val in self.db.execute('SELECT row, col, value FROM cells'):
+            val = json.loads(val)
+            if str(val) != '':
+                cells[(row, col_to_num(col))] = str(val)
+        return cells
+
+    def write(self, updates):
+        rows = []
+        for ticker, api_calls in updates:
+            for row, col, field, val in calls_by_field(api_calls):
+                rows.append((row, ticker, field, col, json.dumps(clean_value(val))))
+        self.db.executemany('REPLACE INTO cells VALUES (?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+SINKS = {'gsheet': None,
+         'csv': CSVSink,
+         'parquet': ParquetSink,
+         'sqlite': SQLiteSink
+         }
+SINK_PATHS = {'csv': 'watchlist.csv',
+              'parquet': 'watchlist.parquet',
+              'sqlite': 'watchlist.sqlite'
+              }
+
+
+def read_watchlist_file(path):
+    # one ticker per line in sheet order, blank lines keep their row like an empty cell in the sheet
+    with open(path, 'r') as file:
+        tickers = [line.strip() for line in file]
+
+    while (len(tickers) > 0) and (tickers[-1] == ''):
+        tickers.pop()
+
+    return tickers
+
+
+def write_batch(sink, updates, journal):
+
+    tickers = [ticker for ticker, api_calls in updates]
+    print('Processing API calls for:', ', '.join(tickers))
+    with timed('write', type(sink).__name__):
+        sink.write(updates)
+    journal.written(tickers)
+    record_written(updates)
+
+
+def scrape_ticker(pool, ticker, row, fields, ciks, known=None):
+    # scrape the selected fields for one ticker and return its TickerRecord
+    print('Getting data for:', ticker, ' at ', 'A'+str(row))
+
+    # fetch the sources the fields need together
+    results, failed = fetch_sources(pool, ticker, field_sources(fields), known)
+    # time spent turning the results into sheet updates
+    start = monotonic()
+    record = fill_record(TickerRecord(ticker, row), fields, results, ciks)
+    add_timing('normalise', '', monotonic() - start)
+
+    # fallback sources nothing else needed, only fetched for fields that are still blank
+    extra = []
+    for field in fields:
+        if is_blank(getattr(record, field.name)):
+            extra += [name for name in field.sources() if (name not in results) and (name not in extra)]
+    if len(extra) > 0:
+        more, more_failed = fetch_sources(pool, ticker, extra, known)
+        results.update(more)
+        failed += more_failed
+        start = monotonic()
+        fill_record(record, fields, results, ciks)
+        add_timing('normalise', '', monotonic() - start)
+
+    if len(failed) > 0:
+        with retry_lock:
+            retry_later[ticker] = (row, {name: result for name, result in results.items() if name not in failed})
+
+    if ('yahoo' in results) and (len(results['yahoo'][0]) == 0):
+        print('Could not get yahoo data for: ', ticker)
+        record.status = 'ERROR'
+
+    print('Updating values in sheets for: ', ticker)
+
+    return record
+
+
+def fetch_worker(work, results, scrape):
+    # pull tickers off the work queue and hand their sheet updates to the writer
+    try:
+        while True:
+            try:
+                ticker, row = work.get_nowait()
+            except queue.Empty:
+                break
+            start = monotonic()
+            try:
+                api_calls = scrape(ticker, row)
+            except Exception as e:
+                print('error scraping ticker: ', ticker, e)
+                api_calls = None
+            took = monotonic() - start
+            ticker_latencies.append(took)
+            add_timing('ticker', '', took)
+            # blocks when the writer is behind
+            results.put((ticker, api_calls))
+            print('Done scraping: ', ticker)
+    finally:
+        results.put(None)
+
+
+def feed_results(items, results):
+    # hand results that are already known to the writer
+    try:
+        for item in items:
+            results.put(item)
+    finally:
+        results.put(None)
+
+
+def record_written(written):
+    # remember what was written for the next incremental run
+    if state_store is None:
+        return
+    for ticker, api_calls in written:
+        state_store.put_calls(ticker, api_calls)
+
+
+class WorkQueue:
+    # tickers shared out to worker processes, each one leased to a worker until it's done or the lease runs out
+
+    def __init__(self, path, lease=300., max_attempts=3):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        # autocommit so leases can take the write lock straight away with BEGIN IMMEDIATE
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tasks (ticker TEXT PRIMARY KEY, row INTEGER, status TEXT, '
+                        'attempts INTEGER, worker TEXT, lease_until REAL, result TEXT, error TEXT, '
+                        'taken INTEGER DEFAULT 0)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+
+    def fill(self, items, meta):
+        # start a new run, meta is shared with the workers along with the lease and attempts
+        meta = dict(meta, lease=self.lease, max_attempts=self.max_attempts)
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('DELETE FROM tasks')
+            self.db.execute('DELETE FROM meta')
+            self.db.executemany("INSERT INTO tasks (ticker, row, status, attempts) VALUES (?, ?, 'queued', 0)",
+                                items)
+            self.db.executemany('INSERT INTO meta VALUES (?, ?)',
+                                [(key, json.dumps(value)) for key, value in meta.items()])
+            self.db.execute('COMMIT')
+
+    def meta(self):
+        with self.lock:
+            rows = self.db.execute('SELECT key, value FROM meta').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def take_lease(self, worker):
+        # next queued ticker, or one whose worker went quiet
+        now = dt.datetime.now().timestamp()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            row = self.db.execute("SELECT ticker, row FROM tasks WHERE (status = 'queued' OR "
+                                  "(status = 'leased' AND lease_until < ?)) AND attempts < ? ORDER BY row LIMIT 1",
+                                  (now, self.max_attempts)).fetchone()
+            if row is not None:
+                self.db.execute("UPDATE tasks SET status = 'leased', attempts = attempts + 1, worker = ?, "
+                                "lease_until = ? WHERE ticker = ?", (worker, now + self.lease, row[0]))
+            self.db.execute('COMMIT')
+        return row
+
+    def complete(self, ticker, worker, api_calls):
+        with self.lock:
+            self.db.execute("UPDATE tasks SET status = 'done', result = ? WHERE ticker = ? AND worker = ? "
+                            "AND status = 'leased'",
+                            (json.dumps([[cell, clean_value(val)] for cell, val in api_calls]), ticker, worker))
+
+    def fail(self, ticker, worker, error):
+        # back in the queue until it runs out of attempts
+        with self.lock:
+            self.db.execute("UPDATE tasks SET status = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, "
+                            "error = ? WHERE ticker = ? AND worker = ? AND status = 'leased'",
+                            (self.max_attempts, error, ticker, worker))
+
+    def take_results(self):
+        # finished tickers the writer hasn't had yet
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            rows = self.db.execute("SELECT ticker, result FROM tasks WHERE status = 'done' AND taken = 0").fetchall()
+            self.db.execute("UPDATE tasks SET taken = 1 WHERE status = 'done' AND taken = 0")
+            self.db.execute('COMMIT')
+        return [(ticker, [tuple(call) for call in json.loads(result)]) for ticker, result in rows]
+
+    def outstanding(self):
+        # tickers still waiting for a worker or being worked on
+        now = dt.datetime.now().timestamp()
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM tasks WHERE (status = 'queued' AND attempts < ?) OR "
+                                   "(status = 'leased' AND (lease_until >= ? OR attempts < ?))",
+                                   (self.max_attempts, now, self.max_attempts)).fetchone()[0]
+
+    def failed(self):
+        # tickers that failed or timed out on every attempt
+        now = dt.datetime.now().timestamp()
+        with self.lock:
+            return self.db.execute("SELECT ticker, error FROM tasks WHERE status = 'failed' OR (status = 'queued' "
+                                   "AND attempts >= ?) OR (status = 'leased' AND lease_until < ? AND attempts >= ?)",
+                                   (self.max_attempts, now, self.max_attempts)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def queue_worker(shared, worker, scrape):
+    # lease tickers from the shared queue until there are none left
+    while True:
+        task = shared.take_lease(worker)
+        if task is None:
+            if shared.outstanding() == 0:
+                break
+            # other workers still have leases that may run out
+            sleep(1)
+            continue
+        ticker, row = task
+        start = monotonic()
+        try:
+            api_calls = scrape(ticker, row)
+        except Exception as e:
+            print('error scraping ticker: ', ticker, e)
+            shared.fail(ticker, worker, str(e))
+            continue
+        add_timing('ticker', '', monotonic() - start)
+        shared.complete(ticker, worker, api_calls)
+        print('Done scraping: ', ticker)
+
+
+def queue_reader(shared, results, procs, poll=1.):
+    # pass results from the worker processes to the writer as they come in
+    try:
+        while True:
+            done = shared.take_results()
+            for result in done:
+                results.put(result)
+            if len(done) > 0:
+                continue
+            if shared.outstanding() == 0:
+                break
+            if (len(procs) > 0) and all(p.poll() is not None for p in procs):
+                # the last results may have come in as the workers finished
+                for result in shared.take_results():
+                    results.put(result)
+                print('All workers stopped with', shared.outstanding(), 'tickers left')
+                break
+            sleep(poll)
+    finally:
+        results.put(None)
+
+
+def spawn_workers(n, args):
+    # worker processes on this machine, more can be started elsewhere with --role worker
+    command = [sys.executable, os.path.abspath(__file__), '--role', 'worker', '--queue', args.queue,
+               '--config', args.config, '--workers', str(args.workers), '--threads', str(args.threads),
+               '--cache-dir', args.cache_dir, '--lease', str(args.lease), '--max-attempts', str(args.max_attempts)]
+    if args.no_cache:
+        command.append('--no-cache')
+    # workers fetch, so they record, replay and keep incremental state the same as the coordinator
+    if args.replay:
+        command += ['--replay', args.replay, '--replay-latency', str(args.replay_latency)]
+    elif args.record:
+        command += ['--record', args.record]
+    if args.incremental:
+        command += ['--incremental', '--state', args.state]
+    return [subprocess.Popen(command) for i in range(n)]
+
+
+def main(argv=None):
+
+    run_start = monotonic()
     parser = argparse.ArgumentParser(description="Watchlist Updater")
     parser.add_argument('--all', help="Update all data", action='store_true')
     parser.add_argument('--new', help="Update new tickers only", action='store_true')
@@ -487,9 +2513,83 @@ def main():
     parser.add_argument('--fundamental', help="Update fundamental & ratio data only", action='store_true')
     parser.add_argument('--insider', help="Update insider buying", action='store_true')
     parser.add_argument('--whale', help="Update whale data", action='store_true')
+    parser.add_argument('--fields', help="Also update these fields, comma separated, e.g. roa,roe,ev", type=str)
     parser.add_argument('--fromticker', help="Continue from ticker", type=str)
-
-    args = parser.parse_args()
+    parser.add_argument('--batchsize', help="Number of tickers to send per sheet write", type=int, default=1)
+    parser.add_argument('--writeback', help="Hold all updates in memory and write them once at the end",
+                        action='store_true')
+    parser.add_argument('--workers', help="Number of tickers scraped at the same time", type=int, default=1)
+    parser.add_argument('--queuesize', help="Max scraped tickers waiting to be written", type=int, default=10)
+    parser.add_argument('--threads', help="Number of threads used to fetch data sources", type=int, default=8)
+    parser.add_argument('--cache-dir', help="Directory for the cache of downloaded pages", type=str, default='.cache')
+    parser.add_argument('--no-cache', help="Don't cache downloaded pages", action='store_true')
+    parser.add_argument('--incremental', help="Only fetch stale sources and only write changed cells",
+                        action='store_true')
+    parser.add_argument('--state', help="State file for incremental runs", type=str, default='watchlist_state.sqlite')
+    parser.add_argument('--force', help="Write every cell even if the sheet already has the value",
+                        action='store_true')
+    parser.add_argument('--history', help="File that keeps every scraped value", type=str,
+                        default='watchlist_history.sqlite')
+    parser.add_argument('--no-history', help="Don't keep scraped values", action='store_true')
+    parser.add_argument('--rebuild', help="Write the sheet from the latest kept values without scraping",
+                        action='store_true')
+    parser.add_argument('--sink', help="Where to write the data, defaults to sink in config.yaml or gsheet",
+                        choices=list(SINKS))
+    parser.add_argument('--sink-path', help="File for the csv, parquet and sqlite sinks", type=str)
+    parser.add_argument('--config', help="Config file", type=str, default='config.yaml')
+    parser.add_argument('--record', help="Save every http response and the sheet to this directory", type=str)
+    parser.add_argument('--replay', help="Play back responses saved with --record instead of using the network",
+                        type=str)
+    parser.add_argument('--replay-latency', help="Seconds to wait for each replayed call", type=float,
+                        default=0.05)
+    parser.add_argument('--summary', help="Write tickers scraped, timings and api call counts to this json file",
+                        type=str)
+    parser.add_argument('--metrics', help="Write time per stage and host to this .json or .prom file", type=str)
+    parser.add_argument('--role', help="Share the tickers out through a queue, the coordinator queues them and "
+                        "writes the results, workers scrape them", choices=['coordinator', 'worker'])
+    parser.add_argument('--queue', help="Queue file shared by the coordinator and workers", type=str,
+                        default='watchlist_queue.sqlite')
+    parser.add_argument('--spawn', help="Number of worker processes the coordinator starts", type=int, default=0)
+    parser.add_argument('--lease', help="Seconds a worker has to finish a ticker before it's handed out again",
+                        type=float, default=300.)
+    parser.add_argument('--max-attempts', help="Times a ticker is handed out before giving up on it", type=int,
+                        default=3)
+
+    parser.add_argument('--retry-passes', help="Times to go back over sources that failed at the end of the run",
+                        type=int, default=1)
+    parser.add_argument('--retry-wait', help="Most seconds to wait for failing hosts to cool down before a retry pass",
+                        type=float, default=60.)
+    parser.add_argument('--journal', help="File that records what each run scraped and wrote", type=str,
+                        default='watchlist_journal.jsonl')
+    parser.add_argument('--resume', help="Carry on with the last run that didn't finish, skipping what it did",
+                        action='store_true')
+
+    argv = sys.argv[1:] if argv is None else argv
+    args = parser.parse_args(argv)
+
+    if len(argv) == 0:
+        print("* NO ARGUMENT SPECIFIED *")
+        parser.print_help()
+        sys.exit(0)
+    unknown = [name for name in field_list(args.fields) if name not in FIELD_NAMES]
+    if len(unknown) > 0:
+        parser.error('unknown fields {}, choose from {}'.format(', '.join(unknown), ', '.join(FIELD_NAMES)))
+
+    # workers only scrape, the coordinator keeps track of the run
+    journal = None
+    resume_run = None
+    if args.role != 'worker':
+        journal = Journal(args.journal)
+        if args.resume:
+            resume_run = journal.unfinished()
+            if resume_run is None:
+                print('No unfinished run to resume in', args.journal)
+                journal.close()
+                return
+            else:
+                # same arguments as the run being resumed
+                argv = resume_run[1]
+                args = parser.parse_args(argv)
 
     new_only = args.new#False
     alldata = args.all#True
@@ -499,18 +2599,47 @@ def main():
     fundamentalonly = args.fundamental#False
     insidersonly = args.insider#False
     whalesonly = args.whale#False
+    field_names = field_list(args.fields)
     fromticker = args.fromticker
+    batchsize = max(1, args.batchsize)
+    writeback = args.writeback
 
-    if len(sys.argv) <= 1:
-        print("* NO ARGUMENT SPECIFIED *")
-        parser.print_help()
-        sys.exit(0)
-
-    with open('config.yaml', 'r') as file:
+    with open(args.config, 'r') as file:
         config = yaml.safe_load(file)
 
     print('** WATCHLIST UPDATER **')
 
+    if args.replay:
+        setup_replay('replay', args.replay, args.replay_latency)
+        print('Replaying responses from', args.replay)
+    elif args.record:
+        setup_replay('record', args.record)
+        print('Recording responses to', args.record)
+    setup_transport()
+
+    set_host_limits(config.get('host_limits', {}))
+    set_rate_limits(config.get('rate_limits', {}))
+    set_retry_policy(config.get('retries', {}), config.get('circuit_breaker', {}), config.get('http_timeout'))
+
+    global http_cache, state_store
+    history = None
+    if ((not args.no_history) or args.rebuild) and (args.role != 'worker'):
+        history = HistoryStore(args.history)
+        if args.rebuild:
+            print('Rebuilding sheet from', args.history)
+        else:
+            history.start_run(argv)
+    if args.incremental:
+        SOURCE_REFRESH.update(config.get('source_refresh', {}))
+        state_store = StateStore(args.state)
+        print('Incremental run using state in', args.state)
+    if (not args.no_cache) and (replay['mode'] is not None):
+        print('Not using the page cache while recording or replaying')
+    elif not args.no_cache:
+        http_cache = open_cache(args.cache_dir, config)
+        print('Using page cache in', args.cache_dir)
+    pool = ThreadPoolExecutor(max_workers=max(1, args.threads))
+
     if alldata:
         print('Updating all data')
     if new_only:
@@ -528,60 +2657,123 @@ def main():
         print('Only updating insiders data')
     if whalesonly:
         print('Only updating whales data')
+    if len(field_names) > 0:
+        print('Updating fields:', ', '.join(field_names))
+    if writeback:
+        print('Writing back whole sheet at end of run')
     if fromticker is not None:
         skip = True
         print('Continuing from ticker: ' + str(fromticker))
 
-    # load in prior tickers to check for new
-    try:
-        prior_tickers = pd.read_csv('prior_tickers.csv', header=None, index_col=0)
-        print('Loaded csv of tickers')
-        print('Prior tickers: \n', prior_tickers)
-    except Exception as e:
-        prior_tickers = []
-        print('Did not load csv of tickers')
-
-    try:
-        ciks = pd.read_csv('ticker_cik.csv', index_col=0)
-        print('Loaded CIKS')
-    except:
-        print('Error loading CIKS')
-
-    # get tickers from ghseets
-    print('Getting tickers from gsheet')
-    maintable, tickers = get_watchlist_tickers(config['gsheet_url'])
-    print('Got tickers from gsheet')
+    if args.role == 'worker':
+        shared = WorkQueue(args.queue, args.lease, args.max_attempts)
+        meta = shared.meta()
+        if 'fields' in meta:
+            # leases and attempts are the coordinator's, so every worker hands tickers out by the same rules
+            shared.lease = meta.get('lease', shared.lease)
+            shared.max_attempts = meta.get('max_attempts', shared.max_attempts)
+            bulk_updown.update(meta['updown'])
+            bulk_finviz.update(meta.get('finviz', {}))
+            queue_fields = select_fields([], meta['fields'])
+            ciks = load_ciks(queue_fields)
+            scrape = lambda ticker, row: scrape_ticker(pool, ticker, row, queue_fields, ciks)
+            name = '{}:{}'.format(socket.gethostname(), os.getpid())
+            print('Worker', name, 'taking tickers from', args.queue)
+            workers = []
+            for n in range(max(1, args.workers)):
+                worker = threading.Thread(target=queue_worker, args=(shared, '{}:{}'.format(name, n), scrape),
+                                          daemon=True)
+                worker.start()
+                workers.append(worker)
+            for worker in workers:
+                worker.join()
+        else:
+            print('Nothing queued in', args.queue)
+        shared.close()
+        pool.shutdown()
+        if http_cache is not None:
+            http_cache.close()
+        if state_store is not None:
+            state_store.close()
+        print_timings(timing_summary())
+        print('** WORKER COMPLETE **')
+        return
+
+    sink_name = args.sink or config.get('sink', 'gsheet')
+    if sink_name == 'gsheet':
+        # get tickers from ghseets
+        print('Getting tickers from gsheet')
+        maintable, tickers, snapshot = get_watchlist_tickers(config.get('gsheet_url'))
+        print('Got tickers from gsheet')
+        sink = GSheetSink(maintable, snapshot)
+    else:
+        sink_path = args.sink_path or config.get('sink_path', SINK_PATHS[sink_name])
+        if 'watchlist_file' in config:
+            print('Getting tickers from', config['watchlist_file'])
+            tickers = read_watchlist_file(config['watchlist_file'])
+        else:
+            print('Getting tickers from gsheet')
+            maintable, tickers, snapshot = get_watchlist_tickers(config.get('gsheet_url'))
+        sink = SINKS[sink_name](sink_path)
+        print('Writing to', sink_name, 'file', sink_path)
+    snapshot = sink.snapshot()
+    row_index = ticker_rows(tickers)
 
     # check for new tickers
     new_tickers = []
-    done_tickers = []
     for ticker in tickers:
         if ticker == "":
             continue
-        if ticker not in prior_tickers[1].values:
+        if ticker not in journal.known:
             new_tickers.append(ticker)
-        else:
-            done_tickers.append(ticker)
     if len(new_tickers) > 0:
         print('New tickers:', new_tickers)
 
+    # a writeback run that didn't finish only wrote at the end, so what it scraped is written before this run
+    leftover = []
+    last_run = journal.unfinished()
+    if (resume_run is None) and (last_run is not None) and ('--writeback' in last_run[1]):
+        leftover = [(ticker, api_calls) for ticker, api_calls in last_run[2].items() if ticker not in last_run[3]]
+
+    # tickers the resumed run already wrote, and ones it scraped but didn't get to write
+    written = set()
+    resumed = {}
+    if resume_run is not None:
+        print('Resuming run from', resume_run[0], 'with', ' '.join(argv))
+        resumed = resume_run[2]
+        written = resume_run[3]
+        journal.start(argv, resume_run[0])
+    else:
+        journal.start(argv)
+
     # FOR TESTING
     #tickers = ['SGBX', 'OEG', 'FTEK', 'HIMX', 'DDD']
 
-    basicdata = ['E', 'F', 'G', 'H', 'I', 'J', 'M', 'V']
-    epsdata = ['X', 'Y', 'Z', 'AA', 'AB', 'AD', 'AE', 'AF', 'AG', 'AI']
-    revdata = ['AJ', 'AK', 'AL', 'AM', 'AO', 'AP', 'AQ', 'AT', 'AR']
-    fundamentaldata = ['AU', 'AV', 'AW', 'AY', 'AZ', 'BA',
-                       'BB', 'BC', 'BF', 'BG', 'BI', 'BJ',
-                       'BL', 'BM', 'BN', 'BO', 'BP', 'BQ',
-                       'BR', 'BS', 'BT', 'BU']
-    insiderdata = ['BX', 'BY', 'BZ', 'CA', 'CB']
-    whaledata = ['CC', 'CD', 'CE', 'CF', 'CG' ,'CH', 'CI', 'CJ']
+    if len(leftover) > 0:
+        try:
+            print('Writing', len(leftover), 'tickers scraped by the unfinished writeback run', last_run[0])
+            if not args.force:
+                leftover = [(ticker, plan_writes(api_calls, snapshot)[0]) for ticker, api_calls in leftover]
+            write_batch(sink, leftover, journal)
+            written.update(ticker for ticker, api_calls in leftover)
+        except Exception as e:
+            print('Failed to write the unfinished run\'s updates: ', e)
 
-    alldata_cols = basicdata + epsdata + revdata + fundamentaldata + insiderdata + whaledata
+    # (ticker, updates) waiting to be written, for the whole run in writeback mode
+    pending = []
+    # writes not needed because the sheet already had the value
+    skipped_writes = 0
+
+    groups = [group for group, selected in zip(FIELD_GROUPS, [basiconly, epsonly, revonly, fundamentalonly,
+                                                               insidersonly, whalesonly]) if alldata or selected]
+    fields = select_fields(groups, field_names)
+    ciks = load_ciks(fields)
+    # tickers to scrape and the finished results waiting to be written
+    work = queue.Queue()
+    results = queue.Queue(maxsize=max(1, args.queuesize))
 
     print('Only update new tickers:', new_only)
-    # loop through tickers are start scraping data for each one and updating gsheet
+    # loop through tickers and queue up the ones to scrape
     for i, ticker in enumerate(tickers):
         #if i < 4:
         #    continue
@@ -593,7 +2785,7 @@ def main():
                 print('Skipping: ', ticker)
                 #done_tickers.append(ticker)
                 continue
-            row = maintable.find(ticker).row
+            row = row_index[ticker]
         else:
             # offset index for row in gsheet
             row = i+3
@@ -606,300 +2798,161 @@ def main():
                 row = i + 3
                 continue
 
-        print('Getting data for:', ticker, ' at ', 'A'+str(row))
-
-        if (alldata) or (basiconly):
-            try:
-                cik = str(get_cik(ciks, ticker))
-            except:
-                cik = ''
-
-        if (alldata) or (basiconly) or (fundamentalonly):
-            # get yfinance yahoo data
-            yahoo_info, topholders = yahoo_data(ticker)
-
-            if len(yahoo_info) == 0:
-                print('Could not get yahoo data for: ', ticker)
-                name, biz, sector, industry, beta, price_to_sales_ttm, forward_pe = '', '', '', '', '' , '', ''
-                profit_margins, ev_to_ebitda, forward_eps, rev_qoq, eps_qoq = '', '', '', '', ''
-                book_value, price_to_book, insider_own, float, ev, peg = '', '', '', '', '', ''
-                maintable.update('C'+str(row), 'ERROR', value_input_option='USER_ENTERED')
-            else:
-                # yahoo data
-                print('Getting yahoo data for: ', ticker)
-                name = yahoo_info['shortName']
-                biz = yahoo_info['longBusinessSummary']
-                sector = yahoo_info['sector']
-                industry = yahoo_info['industry']
-                beta = check_round(yahoo_info['beta'])
-                price_to_sales_ttm = check_round(yahoo_info['priceToSalesTrailing12Months'])
-                forward_pe = check_round(yahoo_info['forwardPE'])
-                profit_margins = check_round(yahoo_info['profitMargins'])
-                ev_to_ebitda = check_round(yahoo_info['enterpriseToEbitda'])
-                forward_eps = check_round(yahoo_info['forwardEps'])
-                # better ones done below #
-                #rev_qoq = check_round(yahoo_info['revenueQuarterlyGrowth'])
-                #eps_qoq = check_round(yahoo_info['earningsQuarterlyGrowth'])
-                # #
-                book_value = check_round(yahoo_info['bookValue'])
-                price_to_book = check_round(yahoo_info['priceToBook'])
-                insider_own = check_round(yahoo_info['heldPercentInsiders'])
-                inst_own = check_round(yahoo_info['heldPercentInstitutions'])
-                try:
-                    float = str(check_round(yahoo_info['floatShares']/1e6))#+'M'
-                except TypeError:
-                    float = ''
-                try:
-                    ev = str(check_round(yahoo_info['enterpriseValue']/1e6))+'M'
-                except TypeError:
-                    ev = ''
-                peg = check_round(yahoo_info['pegRatio'])
-
-        if (alldata) or (fundamentalonly):
-            # scrape extra data fro yahoo statistics page
-            extra_yahoo_info = extra_yahoo_data(ticker)
-
-            print('Getting extra yahoo data for: ', ticker)
-            ev_to_rev = extra_yahoo_info['ev_to_rev']
-            operating_margin = extra_yahoo_info['operating_margin']
-            roa = extra_yahoo_info['roa']
-            roe = extra_yahoo_info['roe']
-            rev = extra_yahoo_info['rev']
-            rev_per_share = extra_yahoo_info['rev_per_share']
-            # better ones done below #
-            rev_growth_yoy = extra_yahoo_info['rev_growth_yoy']
-            eps_growth_yoy = extra_yahoo_info['eps_growth_yoy']
-            # #
-            ebitda = extra_yahoo_info['ebitda']
-            total_cash = extra_yahoo_info['total_cash']
-            cash_per_share = extra_yahoo_info['cash_per_share']
-            debt_to_equity = extra_yahoo_info['debt_to_equity']
-            current_ratio = extra_yahoo_info['current_ratio']
-            book_per_share = extra_yahoo_info['book_per_share']
-            operating_cash_flow_ttm = extra_yahoo_info['operating_cash_flow_ttm']
-            levered_fcf_ttm = extra_yahoo_info['levered_fcf_ttm']
-
-        if (alldata) or (epsonly) or (revonly):
-            print('Getting yahoo growth data for: ', ticker)
-            # get yahoo earnings and sales growth analysis
-            growth_analysis = yahoo_growth_analysis(ticker)
-            #print(growth_analysis)
-            earnings_curr_q = growth_analysis['earnings_curr_q']
-            earnings_next_q = growth_analysis['earnings_next_q']
-            earnings_curr_year = growth_analysis['earnings_curr_year']
-            earnings_next_year = growth_analysis['earnings_next_year']
-            earnings_next_5y = growth_analysis['earnings_next_5y']
-            earning_last_5y = growth_analysis['earnings_past_5y']
-            curr_q_sales_growth = growth_analysis['curr_q_sales_growth']
-            next_q_sales_growth = growth_analysis['next_q_sales_growth']
-            curr_year_sales_growth = growth_analysis['curr_year_sales_growth']
-            next_year_sales_growth = growth_analysis['next_year_sales_growth']
-            eps_beats = growth_analysis['eps_beats']
-            eps_accel = growth_analysis['eps_accel']
-            eps_accel_y = growth_analysis['eps_accel_y']
-            sales_accel = growth_analysis['sales_accel']
-            sales_accel_y = growth_analysis['sales_accel_y']
-
-        if (alldata) or (epsonly) or (revonly):
-            # get finviz data table
-            print('Getting finviz data for:', ticker)
-            finvizdata = scrape_finviz(ticker)
-            if len(finvizdata) == 0:
-                eps_qoq, rev_qoq, gross_margin, eps_last_five_years, eps_next_five_years = '', '', '' , '' , ''
-                earnings_curr_year, earnings_next_year, roa, roe, sales_last_five_years = '', '', '', '', ''
-            else:
-                #print(finvizdata)
-                # only need some finviz data and to fill in for empty yahoo data
-                # keys: Gross Margin, Sales Q/Q, EPS Q/Q, EPS this Y, EPS next Y
-                eps_qoq = check_nan(finvizdata['EPS Q/Q'])
-                rev_qoq = check_nan(finvizdata['Sales Q/Q'])
-                gross_margin = check_nan(finvizdata['Gross Margin'])
-                eps_last_five_years = check_nan(finvizdata['EPS past 5Y'])
-                eps_next_five_years = check_nan(finvizdata['EPS next 5Y'])
-                if eps_last_five_years == '':
-                    eps_last_five_years = earning_last_5y
-                if eps_next_five_years == '':
-                    eps_next_five_years = earnings_next_5y
-                sales_last_five_years = check_nan(finvizdata['Sales past 5Y'])
-                if earnings_curr_year == '':
-                    earnings_curr_year = check_nan(finvizdata['EPS this Y'])
-                if earnings_next_year == '':
-                    earnings_next_year = check_nan(finvizdata['EPS next Y'])
-                if roa == '':
-                    roa = check_nan(finvizdata['ROA'])
-                if roe == '':
-                    roe = check_nan(finvizdata['ROE'])
-
-        if (alldata) or (whalesonly):
-            # get institutional data from whalewidsom
-            whales = scrape_whalewisdom(ticker)
-            nd = len(whales)
-            emp = 0
-            for k, v in whales.items():
-                if v == '':
-                    emp += 1
-            if emp == nd:
-                whales = scrape_whalewisdom(ticker+'-2')
-            print('Getting whales data for: ', ticker)
-            whale_holders = whales['holders']
-            whale_priorq_holders = whales['priorq_holders']
-            whale_new_positions = whales['new_positions']
-            whale_new_positions_lastq = whales['new_positions_lastq']
-            whale_shares = whales['shares']
-            whale_shares_lastq = whales['shares_lastq']
-            whales_own = str(check_round(whales['own']))+'%'
-            if whales_own == '%':
-                whales_own = ''
-
-            if (whale_holders == '') or (whale_priorq_holders == ''):
-                whale_holders_q_change = ''
-            else:
-                whale_holders_q_change = str(int(whale_holders) - int(whale_priorq_holders))
-            if (whale_new_positions == '') or (whale_new_positions_lastq == ''):
-                whale_new_positions_q_change = ''
-            else:
-                whale_new_positions_q_change = str(int(whale_new_positions) - int(whale_new_positions_lastq))
-
-            whale_shares_q_change = ''#whale_shares - whale_shares_lastq
-
-        if (alldata) or (insidersonly):
-            # get insider buys from openinsider
-            #data = {'1Y_buys': num_buys,
-            #        '1Y_totalval': total_value,
-            #        '6M_buys': num_buys,
-            #        '6M_totalval': total_value
-            #        }
-            insiders = scrape_openinsider(ticker)
-            print('Getting insider data for: ', ticker)
-            insider_year_buys = insiders['1Y_buys']
-            insider_year_totalval = insiders['1Y_totalval']
-            insider_6mon_buys = insiders['6M_buys']
-            insider_6mon_totalval = insiders['6M_totalval']
-
-        if (alldata) or (basiconly):
-            print('Getting U/D Vol for:', ticker)
-            updown_vol = check_nan(check_round(get_up_down_vol(ticker)))
-
-            print('Getting earnings date for: ', ticker)
-            earndate = scrape_earnings(ticker)
-
-        print('Updating values in sheets for: ', ticker)
-
-        # update this info to gsheets
-        basicset, epsset, revset, fundamentalset, insiderset, whaleset = [], [], [], [], [], []
-        if (alldata) or (basiconly):
-            basicset = [(basicdata[0] + str(row), name),
-            (basicdata[1] + str(row), biz),
-            (basicdata[2] + str(row), cik),
-            (basicdata[3] + str(row), sector),
-            (basicdata[4] + str(row), industry),
-            (basicdata[5] + str(row), earndate),
-            (basicdata[6] + str(row), float),
-            (basicdata[7] + str(row), updown_vol)]
-        if (alldata) or (epsonly):
-            epsset = [(epsdata[0] + str(row), eps_qoq),
-            (epsdata[1] + str(row), eps_beats),
-            (epsdata[2] + str(row), earnings_curr_q),
-            (epsdata[3] + str(row), earnings_next_q),
-            (epsdata[4] + str(row), eps_accel),
-            (epsdata[5] + str(row), eps_last_five_years),
-            (epsdata[6] + str(row), earnings_curr_year),
-            (epsdata[7] + str(row), earnings_next_year),
-            (epsdata[8] + str(row), eps_accel_y),
-            (epsdata[9] + str(row), eps_next_five_years)]
-        if (alldata) or (revonly):
-            revset = [(revdata[0] + str(row), rev_qoq),
-            (revdata[1] + str(row), curr_q_sales_growth),
-            (revdata[2] + str(row), next_q_sales_growth),
-            (revdata[3] + str(row), sales_accel),
-            (revdata[4] + str(row), sales_last_five_years),
-            (revdata[5] + str(row), curr_year_sales_growth),
-            (revdata[6] + str(row), next_year_sales_growth),
-            (revdata[7] + str(row), gross_margin),
-            (revdata[8] + str(row), sales_accel_y)]
-        if (alldata) or (fundamentalonly):
-            fundamentalset = [(fundamentaldata[0] + str(row), profit_margins),
-            (fundamentaldata[1] + str(row), operating_margin),
-            (fundamentaldata[2] + str(row), rev),
-            (fundamentaldata[3] + str(row), ev_to_rev),
-            (fundamentaldata[4] + str(row), rev_per_share),
-            (fundamentaldata[5] + str(row), price_to_sales_ttm),
-            (fundamentaldata[6] + str(row), price_to_book),
-            (fundamentaldata[7] + str(row), peg),
-            (fundamentaldata[8] + str(row), forward_pe),
-            (fundamentaldata[9] + str(row), ev),
-            (fundamentaldata[10] + str(row), ev_to_ebitda),
-            (fundamentaldata[11] + str(row), ebitda),
-            (fundamentaldata[12] + str(row), beta),
-            (fundamentaldata[13] + str(row), book_per_share),
-            (fundamentaldata[14] + str(row), roa),
-            (fundamentaldata[15] + str(row), roe),
-            (fundamentaldata[16] + str(row), total_cash),
-            (fundamentaldata[17] + str(row), cash_per_share),
-            (fundamentaldata[18] + str(row), debt_to_equity),
-            (fundamentaldata[19] + str(row), current_ratio),
-            (fundamentaldata[20] + str(row), operating_cash_flow_ttm),
-            (fundamentaldata[21] + str(row), levered_fcf_ttm)]
-        if (alldata) or (insidersonly):
-            insiderset = [(insiderdata[0] + str(row), insider_year_buys),
-            (insiderdata[1] + str(row), insider_year_totalval),
-            (insiderdata[2] + str(row), insider_6mon_buys),
-            (insiderdata[3] + str(row), insider_6mon_totalval),
-            (insiderdata[4] + str(row), insider_own)]
-        if (alldata) or (whalesonly):
-            whaleset = [(whaledata[0] + str(row), whale_holders),
-            (whaledata[1] + str(row), whale_holders_q_change),
-            (whaledata[2] + str(row), whale_new_positions),
-            (whaledata[3] + str(row), whale_new_positions_q_change),
-            (whaledata[4] + str(row), whale_shares),
-            (whaledata[5] + str(row), whale_shares_q_change),
-            (whaledata[6] + str(row), whales_own),
-            (whaledata[7] + str(row), topholders)]
-
-        api_calls = basicset + epsset + revset + fundamentalset + insiderset + whaleset
-
-        print('Processing API calls for:', ticker)
-        for call in api_calls:
-            #print(call[0], call[1], type(call[1]))
-            # don't waste time with empty data
-            #if (call[1] == ''):
-            #    continue
-            try:
-                maintable.update(call[0], call[1], value_input_option='USER_ENTERED')
-            except TypeError:
-                maintable.update(call[0], str(call[1]), value_input_option='USER_ENTERED')
-            except Exception as e:
-                print('Data push error: ', e)
-                print('Skipping call for: ', call[0], call[1])
-                sleep(1.2)
-                continue
-            sleep(1.2)
-
-        print('Done scraping: ', ticker)
-
-        if new_only:
-            done_tickers.append(ticker)
-        else:
-            if ticker in new_tickers:
-                done_tickers.append(ticker)
-
-        # save tickers for keeping track what has been updated
-        try:
-            df = pd.DataFrame(done_tickers)
-            df.to_csv('prior_tickers.csv', header=False)
-            print('Updated csv of tickers')
-        except Exception as e:
-            print('Failed to update csv of tickers')
-            pass
+        if ticker in written:
+            print('Already written: ', ticker)
+            continue
+        if ticker in resumed:
+            # written from what was scraped before
+            continue
 
-        # sleep a second just to delay a little
-        sleep(5)
+        work.put((ticker, row))
+
+    # up/down volume and finviz values for every ticker in one go
+    scrape_tickers = [t for t, r in list(work.queue)]
+    if ('updown' in field_sources(fields)) and (not args.rebuild):
+        print('Getting U/D Vol for', len(scrape_tickers), 'tickers')
+        with timed('bulk', 'yahoo'):
+            bulk_updown.update(bulk_up_down_vol(scrape_tickers))
+    # finviz only as a fallback is looked up per ticker when a value is blank
+    if ('finviz' in field_sources(fields)) and (not args.rebuild):
+        print('Getting finviz screener data for', len(scrape_tickers), 'tickers')
+        with timed('bulk', 'finviz'):
+            bulk_finviz.update(bulk_finviz_data(scrape_tickers))
+
+    if args.rebuild:
+        # stored values instead of scraping
+        cols = field_columns(fields)
+        scrape = lambda ticker, row: history.rebuild_calls(ticker, row, cols)
+    else:
+        scrape = lambda ticker, row: scrape_ticker(pool, ticker, row, fields, ciks)
+
+    # fetch with a pool of workers and write from this thread as results come in
+    workers = []
+    shared = None
+    procs = []
+    if (args.role == 'coordinator') and (not args.rebuild):
+        # worker processes do the scraping, this thread reads their results back from the queue
+        shared = WorkQueue(args.queue, args.lease, args.max_attempts)
+        shared.fill(list(work.queue), {'fields': [field.name for field in fields], 'updown': bulk_updown,
+                                      'finviz': bulk_finviz})
+        print('Queued', work.qsize(), 'tickers in', args.queue)
+        procs = spawn_workers(args.spawn, args)
+        worker = threading.Thread(target=queue_reader, args=(shared, results, procs), daemon=True)
+        worker.start()
+        workers.append(worker)
+    else:
+        for n in range(max(1, args.workers)):
+            worker = threading.Thread(target=fetch_worker, args=(work, results, scrape), daemon=True)
+            worker.start()
+            workers.append(worker)
+    resumed_calls = [(ticker, api_calls) for ticker, api_calls in resumed.items() if ticker not in written]
+    if len(resumed_calls) > 0:
+        worker = threading.Thread(target=feed_results, args=(resumed_calls, results), daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    retry_passes = 0 if (shared is not None) or args.rebuild else args.retry_passes
+    running = len(workers)
+    while running > 0:
+        result = results.get()
+        if result is None:
+            running -= 1
+            if (running == 0) and (retry_passes > 0) and (len(retry_later) > 0):
+                # another go at the sources that failed, once their hosts have had a rest
+                retry_passes -= 1
+                retries = take_retries()
+                wait = min(args.retry_wait, max([b.remaining() for b in list(breakers.values())] + [0.]))
+                print('Retrying failed sources for', len(retries), 'tickers in', round(wait), 'seconds')
+                sleep(wait)
+                for ticker, (row, known) in retries.items():
+                    work.put((ticker, row))
+                retry = lambda ticker, row: scrape_ticker(pool, ticker, row, fields, ciks, retries[ticker][1])
+                for n in range(max(1, args.workers)):
+                    worker = threading.Thread(target=fetch_worker, args=(work, results, retry), daemon=True)
+                    worker.start()
+                    running += 1
+            continue
+        ticker, api_calls = result
+        if api_calls is None:
+            continue
 
+        # keep everything scraped, not just what gets written
+        if ticker not in resumed:
+            if (history is not None) and (not args.rebuild):
+                history.add(ticker, api_calls)
+            journal.scraped(ticker, api_calls)
+
+        # skip cells the sheet already has
+        if not args.force:
+            api_calls, skipped = plan_writes(api_calls, snapshot)
+            skipped_writes += skipped
+            calls_to_grid(api_calls, snapshot)
+
+        if state_store is not None:
+            total = len(api_calls)
+            api_calls = state_store.changed_calls(ticker, api_calls)
+            print('Writing', len(api_calls), 'of', total, 'cells for:', ticker)
+
+        # the journal already has what was scraped, writeback runs are rebuilt from it if they die
+        pending.append((ticker, api_calls))
+        if (not writeback) and (len(pending) >= batchsize):
+            write_batch(sink, pending, journal)
+            pending = []
+
+    # send anything left over from the last batch, or the whole run in one go for writeback
+    if len(pending) > 0:
+        if writeback:
+            print('Writing back', len(pending), 'tickers')
+        write_batch(sink, pending, journal)
+
+    if not args.force:
+        print('Skipped', skipped_writes, 'cell writes that were already in the sheet')
+
+    for ticker in take_retries():
+        print('Could not get all sources for', ticker)
+
+    journal.finish()
+    journal.close()
+
+    if shared is not None:
+        for p in procs:
+            p.wait()
+        for ticker, error in shared.failed():
+            print('Gave up on', ticker, error)
+        shared.close()
 
     # remove empty strings for cells i've deleted a ticker
     while("" in tickers):
         tickers.remove("")
 
+    pool.shutdown()
+    sink.close()
+    if http_cache is not None:
+        http_cache.evict()
+        http_cache.close()
+    if state_store is not None:
+        state_store.close()
+    if history is not None:
+        history.close()
+
+    rows = timing_summary()
+    print('Time per stage:')
+    print_timings(rows)
+    if args.metrics:
+        save_metrics(args.metrics, rows, request_counts)
+        print('Wrote metrics to', args.metrics)
+
+    if args.summary:
+        with open(args.summary, 'w') as file:
+            json.dump({'args': argv,
+                       'tickers': len(ticker_latencies),
+                       'seconds': monotonic() - run_start,
+                       'latencies': ticker_latencies,
+                       'requests': request_counts,
+                       'skipped_writes': skipped_writes
+                       }, file, indent=1)
+        print('Wrote run summary to', args.summary)
+
     print('** COMPLETE **')
 
 if __name__ == '__main__': main()
\ No newline at end of file